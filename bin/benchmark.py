@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+benchmark.py
+
+Time the stages of otCMS on a synthetic site, to compare performance across commits
+
+Created by Olivier Thereaux.
+"""
+
+import sys
+import os
+import getopt
+import json
+import time
+import random
+import shutil
+import tempfile
+import contextlib
+import subprocess
+from os.path import join, dirname, exists, realpath
+
+# The library in ../lib/otCMS.py has some classes and helpers to manage entries
+source_tree_otCMS = realpath(join(dirname(__file__), "..", "lib", "otCMS.py"))
+if exists(source_tree_otCMS):
+    sys.path.insert(0, dirname(source_tree_otCMS))
+    try:
+        import otCMS
+    finally:
+        del sys.path[0]
+else:
+    import otCMS
+
+help_message = '''
+benchmark.py - time otCMS on a synthetic catalog, htdocs and photo galleries
+
+Usage: benchmark.py [Options]
+
+Times catalog loading (parsed and cached), indexing, full and incremental
+refresh.py builds (with the time of each stage, see refresh.py --profile),
+makegall.py, thumbnails and the media index, and records them as JSON.
+
+Options:
+    --entries N     number of entries in the catalog (default: 1000)
+    --galleries N   number of entries with a photo gallery (default: 3)
+    --photos N      number of photos in each gallery (default: 20)
+    --jobs N        processes for refresh.py and thumb (default: 1)
+    --seed N        seed of the synthetic site (default: 1)
+    --dir DIR       generate the site in DIR, and keep it (default: a temporary
+                    directory, removed afterwards)
+    --output FILE   write the results to FILE (default: benchmark-N.json, for N entries)
+    -h              this help message
+'''
+
+# (continent, country, region or state, cities, weight) of the places entries are about
+PLACES = [
+    ("Europe", "France", ("Region", "Ile-de-France"), ["Paris", "Versailles"], 20),
+    ("Europe", "France", ("Region", "Bretagne"), ["Rennes", "Brest", "Saint-Malo"], 8),
+    ("Europe", "France", ("Region", "Provence"), ["Marseille", "Nice", "Avignon"], 6),
+    ("Europe", "UK", ("Region", "England"), ["London", "Manchester", "Bristol"], 18),
+    ("Europe", "UK", ("Region", "Scotland"), ["Edinburgh", "Glasgow"], 4),
+    ("Europe", "Spain", ("Region", "Catalonia"), ["Barcelona", "Girona"], 5),
+    ("Europe", "Spain", None, ["Madrid", "Sevilla"], 4),
+    ("Europe", "Italy", None, ["Rome", "Venice", "Florence"], 4),
+    ("Europe", "Germany", None, ["Berlin", "Munich"], 3),
+    ("Asia", "Japan", ("Region", "Kanto"), ["Tokyo", "Yokohama", "Kamakura"], 12),
+    ("Asia", "Japan", ("Region", "Kansai"), ["Kyoto", "Osaka", "Nara"], 8),
+    ("Asia", "China", None, ["Beijing", "Shanghai"], 2),
+    ("Asia", "Vietnam", None, ["Hanoi", "Hue"], 2),
+    ("America", "USA", ("State", "California"), ["San Francisco", "Los Angeles"], 6),
+    ("America", "USA", ("State", "Massachusetts"), ["Boston", "Cambridge"], 4),
+    ("America", "USA", ("State", "New York"), ["New York"], 4),
+    ("America", "Canada", ("State", "Quebec"), ["Montreal", "Quebec"], 5),
+    ("Oceania", "Australia", None, ["Sydney", "Melbourne"], 2),
+    ("Africa", "Morocco", None, ["Marrakech", "Fes"], 1),
+]
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipisicing elit sed do eiusmod tempor incididunt ut labore "
+         "et dolore magna aliqua photo street light city morning evening rain train walk market temple river "
+         "bridge night harbour museum garden mountain coffee ville soleil rue marché pluie nuit été hiver").split()
+
+
+def sentence(rnd, low, high):
+    return " ".join(rnd.choice(WORDS) for i in range(rnd.randint(low, high))).capitalize()
+
+
+def makeCatalog(count, rnd):
+    """catalog entries (dicts, newest first) of a synthetic site of count entries"""
+    catalog = list()
+    weights = [place[4] for place in PLACES]
+    for i in range(count):
+        if i % 100 == 99: # a few pages which are not dated, like the contact page
+            catalog.append({"URI": "/page-%d.html" % i, "Title": "Page %d" % i, "Language": "en"})
+            continue
+        # more recent years have more entries
+        year = 2016 - int(rnd.triangular(0, 17, 0))
+        pubdate = "%d-%02d-%02dT%02d:%02d:42Z" % (year, rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59))
+        uri = "/%d/%s-%s-%d/" % (year, pubdate[5:7], rnd.choice(WORDS), i)
+        entry = {"URI": uri, "Title": sentence(rnd, 1, 5), "Pubdate": pubdate, "Year": year,
+                 "Language": "fr" if rnd.random() < 0.4 else "en"}
+        if rnd.random() < 0.9:
+            continent, country, region, cities, weight = rnd.choices(PLACES, weights)[0]
+            entry["Continent"] = continent
+            entry["Country"] = country
+            if region:
+                entry[region[0]] = region[1]
+            if rnd.random() < 0.05 and len(cities) > 1:
+                entry["City"] = rnd.sample(cities, 2) # a trip through several cities
+            elif rnd.random() < 0.8:
+                entry["City"] = rnd.choice(cities)
+        if rnd.random() < 0.7:
+            entry["Abstract"] = sentence(rnd, 10, 40)
+            entry["Thumbnail"] = uri+"tn/tn_1.jpg.jpg"
+            entry["Photos"] = rnd.randint(3, 40)
+        if rnd.random() < 0.02:
+            entry["Featured"] = True
+        catalog.append(entry)
+    catalog.sort(key=lambda entry: entry.get("Pubdate", ""), reverse=True)
+    return catalog
+
+
+def makeSite(htdocs, count, galleries, photos, rnd):
+    """write the catalog, MarkDown sources and photo galleries of a synthetic site. Returns the catalog path"""
+    catalog = makeCatalog(count, rnd)
+    catalog_path = join(htdocs, "catalog.py")
+    with open(catalog_path, "w") as catalog_fh:
+        catalog_fh.write("# Synthetic catalog, see bin/benchmark.py\n")
+        catalog_fh.write(repr(catalog))
+    for entry in catalog:
+        cms_entry = otCMS.otCMSEntry()
+        cms_entry.fromdict(entry)
+        source = join(htdocs, cms_entry.paths()[0])
+        if not exists(dirname(source)):
+            os.makedirs(dirname(source))
+        with open(source, "w") as source_fh:
+            source_fh.write("# %s\n\n" % entry["Title"])
+            for paragraph in range(rnd.randint(2, 12)):
+                source_fh.write(sentence(rnd, 20, 120)+".\n\n")
+                if rnd.random() < 0.5:
+                    source_fh.write('<div class="picCenter picCaption">\n<img src="%d.jpg" />\n<p>%s</p>\n</div>\n\n' % (paragraph+1, sentence(rnd, 3, 10)))
+    gallery_dirs = list()
+    try:
+        from PIL import Image
+    except ImportError:
+        print("Pillow is not installed, no photo galleries", file=sys.stderr)
+        return catalog_path, gallery_dirs
+    for entry in [entry for entry in catalog if "Year" in entry][:galleries]:
+        gallery_dir = join(htdocs, entry["URI"].strip("/"))
+        for i in range(photos):
+            size = rnd.choice([(2048, 1365), (1365, 2048), (2048, 1536)])
+            image = Image.new("RGB", size, (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)))
+            image.paste((rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)), (0, 0, size[0]//2, size[1]//3))
+            name = "%02d-%s" % (i+1, rnd.choice(WORDS))
+            image.save(join(gallery_dir, name+".jpg"), "JPEG", quality=85)
+            with open(join(gallery_dir, name+".rdf"), "w") as rdf_fh:
+                rdf_fh.write('<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:s0="http://www.w3.org/2000/PhotoRDF/dc-1-0#">'
+                             '<rdf:Description><s0:title>%s</s0:title><s0:description>%s</s0:description></rdf:Description></rdf:RDF>'
+                             % (sentence(rnd, 1, 4), sentence(rnd, 5, 15)))
+        gallery_dirs.append(gallery_dir)
+    return catalog_path, gallery_dirs
+
+
+def loadScript(name):
+    """one of the scripts next to this one, as a module"""
+    import importlib.machinery
+    import importlib.util
+    loader = importlib.machinery.SourceFileLoader(name, join(dirname(realpath(__file__)), name if name == "thumb" else name+".py"))
+    script = importlib.util.module_from_spec(importlib.util.spec_from_loader(name, loader))
+    # registered, for the functions run in worker processes
+    sys.modules[name] = script
+    loader.exec_module(script)
+    return script
+
+
+@contextlib.contextmanager
+def timed(results, name):
+    """time a block, in results[name], without its output"""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        yield
+        results[name] = time.perf_counter() - started
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=dirname(realpath(__file__)), stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def benchmark(htdocs, count, galleries, photos, jobs, seed):
+    """generate a synthetic site in htdocs, and time otCMS on it"""
+    results = dict()
+    rnd = random.Random(seed)
+    with timed(results, "generate site"):
+        catalog_path, gallery_dirs = makeSite(htdocs, count, galleries, photos, rnd)
+
+    with timed(results, "catalog parse"):
+        entries = otCMS.otCMSCatalog()
+        entries.fromfile(catalog_path, use_cache=False)
+    with timed(results, "catalog parse and compile"):
+        entries = otCMS.otCMSCatalog()
+        entries.fromfile(catalog_path)
+    with timed(results, "catalog compiled"):
+        entries = otCMS.otCMSCatalog()
+        entries.fromfile(catalog_path)
+    with timed(results, "index"):
+        otCMS.otCMSIndex(entries)
+
+    refresh = loadScript("refresh")
+    options = refresh.default_options()
+    options["jobs"] = jobs
+    options["feeds"]["all"] = True
+    # the same picks of nearby and featured entries from one run to the next
+    options["picks"]["seed"] = str(seed)
+    profile = otCMS.otCMSProfile()
+    state = dict()
+    try:
+        with timed(results, "refresh full"):
+            refresh.refresh(entries, catalog_path, htdocs, options, state=state, profile=profile)
+    finally:
+        if "executor" in state:
+            state["executor"].shutdown()
+    state = dict()
+    try:
+        with timed(results, "refresh incremental, unchanged"):
+            refresh.refresh(entries, catalog_path, htdocs, dict(options, incremental=True), state=state)
+        changed = entries[len(entries)//2]
+        with open(join(htdocs, changed.paths()[0]), "a") as source_fh:
+            source_fh.write("\nOne more paragraph.\n")
+        with timed(results, "refresh incremental, one entry changed"):
+            refresh.refresh(entries, catalog_path, htdocs, dict(options, incremental=True), state=state)
+    finally:
+        if "executor" in state:
+            state["executor"].shutdown()
+
+    if gallery_dirs:
+        thumb = loadScript("thumb")
+        with timed(results, "thumbnails"):
+            thumb.main(["thumb", "--force", "--jobs", str(jobs)] + gallery_dirs)
+        mediaindex = loadScript("mediaindex")
+        with timed(results, "media index"):
+            mediaindex.main(["mediaindex.py", "--htdocs", htdocs])
+        makegall = loadScript("makegall")
+        cwd = os.getcwd()
+        try:
+            os.chdir(gallery_dirs[0])
+            with timed(results, "makegall"):
+                makegall.main(["makegall.py", "--lazy"])
+        finally:
+            os.chdir(cwd)
+
+    return {"commit": gitCommit(), "python": sys.version.split()[0], "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "entries": count, "galleries": len(gallery_dirs), "photos": photos, "jobs": jobs, "seed": seed,
+            "results": results, "profile": profile.todict()}
+
+
+def main(argv=None):
+    count = 1000
+    galleries = 3
+    photos = 20
+    jobs = 1
+    seed = 1
+    htdocs = None
+    output = None
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "h", ["help", "entries=", "galleries=", "photos=", "jobs=", "seed=", "dir=", "output="])
+    except getopt.error as msg:
+        print(sys.argv[0].split("/")[-1] + ": " + str(msg), file=sys.stderr)
+        print("\t for help use --help", file=sys.stderr)
+        return 2
+
+    # option processing
+    for option, value in opts:
+        if option == "--entries":
+            count = int(value)
+        if option == "--galleries":
+            galleries = int(value)
+        if option == "--photos":
+            photos = int(value)
+        if option == "--jobs":
+            jobs = max(1, int(value))
+        if option == "--seed":
+            seed = int(value)
+        if option == "--dir":
+            htdocs = realpath(value)
+        if option == "--output":
+            output = value
+        if option in ("-h", "--help"):
+            print(help_message)
+            sys.exit()
+
+    output = output or "benchmark-%d.json" % count
+    keep = htdocs != None
+    if keep:
+        if exists(htdocs) and os.listdir(htdocs):
+            print("%s is not empty" % htdocs, file=sys.stderr)
+            return 2
+        os.makedirs(htdocs, exist_ok=True)
+    else:
+        htdocs = tempfile.mkdtemp(prefix="otcms-benchmark-")
+    try:
+        report = benchmark(htdocs, count, galleries, photos, jobs, seed)
+    finally:
+        if not keep:
+            shutil.rmtree(htdocs)
+
+    for name, seconds in report["results"].items():
+        print("%-40s %10.3f" % (name, seconds))
+    with open(output, "w") as output_fh:
+        json.dump(report, output_fh, indent=2, sort_keys=True)
+    print("Results written to %s" % output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
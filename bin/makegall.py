@@ -12,6 +12,19 @@ import sys
 import os
 import re
 import getopt
+from os.path import join, dirname, exists, realpath
+from xml.sax.saxutils import escape
+
+# The library in ../lib/otCMS.py has some classes and helpers to manage entries
+source_tree_otCMS = realpath(join(dirname(__file__), "..", "lib", "otCMS.py"))
+if exists(source_tree_otCMS):
+    sys.path.insert(0, dirname(source_tree_otCMS))
+    try:
+        import otCMS
+    finally:
+        del sys.path[0]
+else:
+    import otCMS
 
 help_message = '''
 makegall.py - Find jpg fnames in current dir and output basic gallery markup
@@ -24,12 +37,21 @@ Options:
     -h        this help message
 '''
 
-def getImageSizes(fname):
-    """calculate actual and relative dimensions of image"""
+def getImageSizes(fname, image_sizes=None):
+    """calculate actual and relative dimensions of image
+
+    Dimensions are read from the image headers, honouring EXIF orientation,
+    and cached per directory (see otCMS.otCMSImageSizes)
+    """
+    if image_sizes == None:
+        image_sizes = otCMS.otCMSImageSizes(dirname(fname) or ".")
+    return relativeSizes(*image_sizes.size(os.path.basename(fname)))
+
+
+def relativeSizes(width, height):
+    """actual and relative dimensions, for an image of the given dimensions"""
     sizes = dict()
-    from PIL import Image
-    im=Image.open(fname)
-    (sizes["width"], sizes["height"]) = im.size
+    (sizes["width"], sizes["height"]) = (width, height)
     if sizes["width"] >= sizes["height"]:
         sizes["rel_width"] = 600
         try:
@@ -47,35 +69,38 @@ def getImageSizes(fname):
 
 
 def readRDF(fname):
-    """Yes, this is how I parse my PhotoRDF. Sue me."""
-    try:
-        rdf = open(fname, "r").read()
-    except Exception as e:
-        raise e
-        return "", ""
-    title = ''
-    description = ''
-    coverage = ''
-    try:
-        title = re.search(r'<s[0-9]:title>(.*)</s[0-9]:title>', rdf).group(1)
-    except Exception as e:
-        pass
-    try:
-        description = re.search(r'<s[0-9]:description>(.*)</s[0-9]:description>', rdf).group(1)
-    except:
-        pass
-    try:
-        coverage = re.search(r'<s[0-9]:coverage>(.*)</s[0-9]:coverage>', rdf).group(1)
-    except:
-        pass
+    """title and description text for a photo, from its PhotoRDF file"""
+    return photoCaption(otCMS.readPhotoRDF(fname))
+
+
+def photoCaption(photo):
+    """title and description text for a photo, from its PhotoRDF metadata
+
+    Both are escaped for use in markup and attribute values.
+    """
+    title = photo["title"]
+    description = photo["description"]
+    coverage = photo["coverage"]
     if description == coverage:
         description = title + " – "+coverage
-    try:
-        date = re.search(r'<s0:date>(.*)</s0:date>', rdf).group(1)
-        description = description + ", " + date
-    except:
-        pass
-    return title, description
+    if photo["date"]:
+        description = description + ", " + photo["date"]
+    return escape(title, {'"': "&quot;"}), escape(description, {'"': "&quot;"})
+
+
+def indexedPhoto(media_records, fname, dirList):
+    """record of an image in the site media index, if it is up to date"""
+    record = media_records.get(fname)
+    if record == None:
+        return None
+    st = os.stat(fname)
+    if record["mtime"] != st.st_mtime_ns or record["size"] != st.st_size:
+        return None
+    rdf_fname = otCMS.rdfName(fname)
+    rdf_mtime = os.stat(rdf_fname).st_mtime_ns if rdf_fname in dirList else None
+    if record["rdf_mtime"] != rdf_mtime:
+        return None
+    return record
 
 
 def main(argv=None):
@@ -139,22 +164,39 @@ def main(argv=None):
     </div>'''
     dirList=os.listdir(".")
     dirList.sort()
+    # sizes and captions come from the site media index (see mediaindex.py) when it is up to date
+    media_index, media_dir = otCMS.findMediaIndex(".")
+    media_records = media_index.directory(media_dir) if media_index else dict()
+    indexed = dict()
+    for fname in dirList:
+        if re.search(r".jpg$", fname):
+            indexed[fname] = indexedPhoto(media_records, fname, dirList)
+    image_sizes = otCMS.otCMSImageSizes(".")
+    image_sizes.probe([fname for fname in indexed if indexed[fname] == None])
+    # all the .rdf files of the directory, parsed only if they changed since the last run
+    photo_rdfs = otCMS.otCMSPhotoRDFs(".")
+    photos = photo_rdfs.read(dirList)
     for fname in dirList:
         if re.search(r".jpg$", fname):
-            sizes = getImageSizes(fname)
-            file_base = re.sub(r"\..*$", "", fname)
+            record = indexed[fname]
+            if record:
+                sizes = relativeSizes(record["width"], record["height"])
+            else:
+                sizes = getImageSizes(fname, image_sizes)
             alt_text = ''
             link_text = ''
             title_text = ''
-            rdf_fname = file_base+".rdf"
-            if rdf_fname in dirList:
-                title, description = readRDF(rdf_fname)
+            rdf_fname = otCMS.rdfName(fname)
+            if rdf_fname in photos:
+                title, description = photoCaption(record or photos[rdf_fname])
                 alt_text = "Photo: "+title
                 title_text = description
                 link_text = title
             print(template_markup % {"fname": fname, 'alt_text': alt_text, "link_text": link_text, "title_text": title_text, "rel_width": sizes["rel_width"], "rel_height": sizes["rel_height"]})
     if mode == "thumb":
         print('</div>')
+    image_sizes.save()
+    photo_rdfs.save()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+mediaindex.py
+
+Index dimensions, thumbnails and PhotoRDF metadata of all images of the site
+
+Created by Olivier Thereaux.
+"""
+
+import sys
+import os
+import getopt
+import time
+from os.path import join, dirname, exists, realpath
+
+# The library in ../lib/otCMS.py has some classes and helpers to manage entries
+source_tree_otCMS = realpath(join(dirname(__file__), "..", "lib", "otCMS.py"))
+if exists(source_tree_otCMS):
+    sys.path.insert(0, dirname(source_tree_otCMS))
+    try:
+        import otCMS
+    finally:
+        del sys.path[0]
+else:
+    import otCMS
+
+help_message = '''
+mediaindex.py - index all images under htdocs, for makegall.py and refresh.py
+
+The index is kept in .otcms-cache/media.json under htdocs, and only images
+or .rdf files which changed since the last run are read again.
+
+Options:
+    --htdocs  root of the site (default: current directory)
+    -h        this help message
+'''
+
+
+def main(argv=None):
+    htdocs = realpath(os.path.curdir)
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "h", ["help", "htdocs="])
+    except getopt.error as msg:
+        print(sys.argv[0].split("/")[-1] + ": " + str(msg), file=sys.stderr)
+        print("\t for help use --help", file=sys.stderr)
+        return 2
+
+    # option processing
+    for option, value in opts:
+        if option == "--htdocs":
+            htdocs = realpath(value)
+        if option in ("-h", "--help"):
+            print(help_message)
+            sys.exit()
+
+    started = time.time()
+    media_index = otCMS.otCMSMediaIndex(htdocs).load()
+    indexed = media_index.update()
+    media_index.save()
+    print("%d images in %s, %d (re)indexed in %.2fs" % (len(media_index.images), media_index.path, indexed, time.time()-started))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
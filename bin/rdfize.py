@@ -11,9 +11,51 @@ Created by olivier Thereaux on 2008-12-21.
 import sys
 import os
 import re
+import csv
+import json
+import getopt
+from os.path import join, dirname, exists, realpath
+from xml.sax.saxutils import escape
 
-def main():
-    rdf_template = """<?xml version='1.0' encoding='utf-8'?>
+# The library in ../lib/otCMS.py has some classes and helpers to manage entries
+source_tree_otCMS = realpath(join(dirname(__file__), "..", "lib", "otCMS.py"))
+if exists(source_tree_otCMS):
+    sys.path.insert(0, dirname(source_tree_otCMS))
+    try:
+        import otCMS
+    finally:
+        del sys.path[0]
+else:
+    import otCMS
+
+help_message = '''
+rdfize.py - write a PhotoRDF (.rdf) file for each .jpg image of a directory
+
+Usage: rdfize.py [Options] [directory ...]
+
+Without --batch, asks for the title, location, date and description of each
+image in the current directory.
+
+Options:
+    --batch          do not ask: take titles from file names, dates from EXIF
+                     (DateTimeOriginal), and the rest from the options below
+                     or the sidecar file. Only missing or changed .rdf files
+                     are written
+    --location LOC   location of the album
+    --date DATE      date of the album, for images without an EXIF date
+    --description D  description of the album (default: title of each image)
+    --sidecar FILE   CSV or JSON file with album defaults and per-image values
+                     (default: rdfize.csv or rdfize.json in each directory)
+    --keep           in batch mode, never overwrite existing .rdf files
+    -h               this help message
+
+A CSV sidecar has a header row with file, title, location, date and description
+columns; the row with an empty file holds album defaults. A JSON sidecar is an
+object with album defaults, and per-image values in "photos", keyed by file name:
+    {"location": "Paris", "photos": {"01-louvre.jpg": {"title": "Le Louvre"}}}
+'''
+
+rdf_template = """<?xml version='1.0' encoding='utf-8'?>
       <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
           xmlns:rdfs="http://www.w3.org/TR/1999/PR-rdf-schema-19990303#"
           xmlns:s0="http://www.w3.org/2000/PhotoRDF/dc-1-0#"
@@ -30,18 +72,100 @@ def main():
         </rdf:Description>
       </rdf:RDF>
     """
+
+PHOTO_FIELDS = ["title", "location", "date", "description"]
+
+image_re = re.compile(r".jpg$")
+# 12-la_tour_eiffel-2.jpg -> "la tour eiffel"
+title_subs = [(re.compile("_"), " "), (re.compile(r"\d+-"), ""), (re.compile(".jpg"), ""), (re.compile(r"[0-9-]+$"), "")]
+
+
+def inferTitle(fname_img):
+    """title of an image, from its file name"""
+    infer_title = fname_img
+    for pattern, replacement in title_subs:
+        infer_title = pattern.sub(replacement, infer_title)
+    return infer_title
+
+
+def exifDate(fname_img):
+    """date (YYYY-MM-DD) an image was taken, from its EXIF headers, or None"""
+    try:
+        info = otCMS.probeJPEG(fname_img)
+    except (IOError, OSError, ValueError):
+        return None
+    if info == None or not re.match(r"\d{4}:\d\d:\d\d", info.get("datetime_original", "")):
+        return None
+    return info["datetime_original"][:10].replace(":", "-")
+
+
+def rdfText(title, location, date, description):
+    """PhotoRDF for an image. The location is appended to the description"""
+    delimiter = " "
+    if description == "":
+        description = title
+    if (len(description) != 0):
+        if (description[-1] != "."):
+            delimiter = " – "
+    return rdf_template % {"TITLE": escape(title), "LOCATION": escape(location),
+    "DATE": escape(date), "DESCRIPTION": escape(description), "DELIMITER": delimiter}
+
+
+def readSidecar(sidecar_fn):
+    """album defaults and per-image values from a CSV or JSON sidecar file"""
+    album = dict()
+    photos = dict()
+    if sidecar_fn.endswith(".json"):
+        with open(sidecar_fn, "r") as sidecar_fh:
+            sidecar = json.load(sidecar_fh)
+        photos = sidecar.pop("photos", dict())
+        album = sidecar
+    else:
+        with open(sidecar_fn, "r", newline="") as sidecar_fh:
+            for row in csv.DictReader(sidecar_fh):
+                photo = dict((field, value) for field, value in row.items() if field in PHOTO_FIELDS and value)
+                if row.get("file"):
+                    photos[row["file"]] = photo
+                else:
+                    album.update(photo)
+    return album, photos
+
+
+def batch(directory, defaults, sidecar_fn=None, keep=False):
+    """write the .rdf files of a directory without asking. Returns the writer, for its counters"""
+    writer = otCMS.otCMSWriter(directory)
+    if sidecar_fn == None:
+        for fname in ("rdfize.csv", "rdfize.json"):
+            if exists(join(directory, fname)):
+                sidecar_fn = join(directory, fname)
+    album, photos = readSidecar(sidecar_fn) if sidecar_fn else (dict(), dict())
+    # album defaults given as options win over the sidecar
+    album.update(defaults)
+    for fname_img in sorted(os.listdir(directory)):
+        if not image_re.search(fname_img):
+            continue
+        fname_rdf = otCMS.rdfName(fname_img)
+        if keep and exists(join(directory, fname_rdf)):
+            continue
+        photo = photos.get(fname_img, dict())
+        title = photo.get("title") or inferTitle(fname_img)
+        date = photo.get("date") or exifDate(join(directory, fname_img)) or album.get("date", "")
+        rdf_text = rdfText(title, photo.get("location") or album.get("location", ""), date,
+                           photo.get("description") or album.get("description", ""))
+        writer.write(fname_rdf, rdf_text)
+    return writer
+
+
+def interactive():
+    """ask for the metadata of each image in the current directory"""
     album_location = input('Location?    ')
     album_date = input('Date?    ')
     dirList=os.listdir(".")
     for fname_img in dirList:
-        if re.search(r".jpg$", fname_img):
-            fname_rdf = re.sub(".jpg", ".rdf", fname_img)
+        if image_re.search(fname_img):
+            fname_rdf = otCMS.rdfName(fname_img)
             print(("\nProcessing %s…" % fname_img))
-            infer_title = fname_img
-            infer_title = re.sub("_", " ", infer_title)
-            infer_title = re.sub("\d+-", "", infer_title)
-            infer_title = re.sub(".jpg", "", infer_title)
-            infer_title = re.sub(r"[0-9-]+$", "", infer_title)
+            infer_title = inferTitle(fname_img)
             input_title = input('Title? (Default: %s)    ' % infer_title)
             if input_title == "":
                 input_title = infer_title
@@ -52,18 +176,48 @@ def main():
             if input_date == "":
                 input_date = album_date
             input_desc = input('Description? (Default: %s) ' % input_title)
-            delimiter = " "
-            if input_desc == "":
-                input_desc = input_title
-            if (len(input_desc) != 0):
-                if (input_desc[-1] != "."):
-                    delimiter = " – "
-
-            rdf_text = rdf_template % {"TITLE": input_title, "LOCATION": input_location,
-            "DATE": input_date, "DESCRIPTION": input_desc, "DELIMITER": delimiter}
+
+            rdf_text = rdfText(input_title, input_location, input_date, input_desc)
             file_rdf = open(fname_rdf, 'w')
             file_rdf.write(rdf_text)
             file_rdf.close()
 
+
+def main(argv=None):
+    batch_mode = False
+    keep = False
+    sidecar_fn = None
+    defaults = dict()
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "h", ["help", "batch", "location=", "date=", "description=", "sidecar=", "keep"])
+    except getopt.error as msg:
+        print(sys.argv[0].split("/")[-1] + ": " + str(msg), file=sys.stderr)
+        print("\t for help use --help", file=sys.stderr)
+        return 2
+
+    # option processing
+    for option, value in opts:
+        if option == "--batch":
+            batch_mode = True
+        if option in ("--location", "--date", "--description"):
+            defaults[option[2:]] = value
+        if option == "--sidecar":
+            sidecar_fn = value
+        if option == "--keep":
+            keep = True
+        if option in ("-h", "--help"):
+            print(help_message)
+            sys.exit()
+
+    if not batch_mode:
+        interactive()
+        return 0
+    for directory in args or ["."]:
+        writer = batch(directory, defaults, sidecar_fn, keep)
+        print("%s: %d .rdf files written, %d unchanged" % (directory, writer.written, writer.unchanged))
+    return 0
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -10,13 +10,10 @@ Created by Olivier Thereaux on 2013-01-03.
 import sys
 import getopt
 import os
-import random
 import re
-import cgi
 import time
+import json
 from os.path import join, dirname, exists, realpath
-import markdown2
-from feedgen.feed import FeedGenerator
 
 # The library in ../lib/otCMS.py has some classes and helpers to manage entries
 source_tree_otCMS = realpath(join(dirname(__file__), "..", "lib", "otCMS.py"))
@@ -29,6 +26,27 @@ if exists(source_tree_otCMS):
 else:
     import otCMS
 
+TEMPLATES_DIR = realpath(join(dirname(__file__), "..", "templates"))
+# tags and comments, removed from abstracts for page descriptions
+tag_re = re.compile(r'(<!--.*?-->|<[^>]*>)')
+
+# paths, title and links of the main feed, see site_feeds for the others
+MAIN_FEED = {"atom": "atom.xml", "rss": "rss.xml", "id": "", "title": None, "alternate": "/", "links": [], "archive": False}
+LANGUAGE_TITLES = {"en": "in English", "fr": "en Français"}
+# every path site_feeds may generate, for removing feeds which are no longer generated
+feed_output_re = re.compile(r'^((atom|rss)(_\w+)?\.xml|archives/\d+\.xml|\d+/(atom|rss)\.xml|geo/[^/]+\.(xml|rss))$')
+FEED_TAILS = {"atom": "</feed>\n", "rss": "  </channel>\n</rss>\n"}
+
+# Rewriting of entry bodies for the Atom feed: absolute image URIs (big thumbnails
+# instead of photos), no links, no lazy-loaded images, and plain captions
+atom_src_re = re.compile(r'src="(tn|[0-9])')
+atom_link_re = re.compile(r'<a href[^>]*>(.*)</a>', re.MULTILINE)
+atom_lazy_img_re = re.compile(r'<img class="lazy".* />')
+atom_img_re = re.compile(r'<img src')
+atom_noscript_re = re.compile(r'<noscript>(.*)</noscript>')
+atom_caption_re = re.compile(r'<div class="picCenter picCaption">\s*<img(.*)/img>\s*<p>(.*)</p>\s*</div>', re.MULTILINE)
+atom_caption_closed_re = re.compile(r'<div class="picCenter picCaption">\s*<img(.*) />\s*<p>(.*)</p>\s*</div>', re.MULTILINE)
+atom_sized_img_re = re.compile(r'<img width="600" src="(https://olivier\.thereaux\.net)/([^"]*)"')
 
 
 def usage():
@@ -47,14 +65,154 @@ Options:
                 By default, will consider path of catalog file to be the root
     -p          use  private catalog.
                 Will only generate entries, no indexes
+    --incremental
+                only regenerate files whose catalog data, MarkDown source,
+                templates or neighbouring entries changed since the last run
+    --jobs N    render entry pages with N processes (default: 1)
+    --watch     after refreshing, keep watching the catalog, MarkDown sources
+                and templates, and refresh incrementally when they change
+    --feeds     besides atom.xml, generate paged archives of all entries
+                (archives/N.xml, RFC 5005), and feeds per language (atom_en.xml),
+                year (2012/atom.xml) and location (geo/paris.xml)
+    --rss       also generate RSS 2.0 versions of the feeds (rss.xml, ...)
+    --feed-size N
+                number of entries in each feed and archive page (default: 49)
+    --compress  also write compressed copies of generated files (.gz, and .br
+                if the brotli module is installed), for web servers to serve
+                as they are. Only files which changed are compressed again.
+                .br files are compressed at quality 9 (otCMS.BROTLI_QUALITY)
+                rather than 11: nearly as small, and much faster to make
+    --search    also generate a search index of entries (search/), from their
+                titles, locations and abstracts, in JSON files split by the
+                first letters of words, for pages to search without loading
+                every entry. See otCMS.otCMSSearchIndex for its format
+    --search-bodies
+                with --search, also index the text of entries
+    --seed SEED pick the nearby entries of each entry page, and the entries
+                featured on the home page, from SEED instead of at random, so
+                that pages only change when the entries they list change
+    --rotate DAYS
+                with --seed, pick other entries every DAYS days
+    --profile   print the time spent in each stage and template, the slowest
+                entries, cache hit rates and bytes written
+    --profile-json FILE
+                also write that profile to FILE, as JSON
+    --profile-pstats FILE
+                also run the build under cProfile, and write its stats to FILE
+                (for python -m pstats). Entry pages rendered in other
+                processes (--jobs) are not included
     -h (--help) This help message
+
+Caches are kept in .otcms-cache, next to the catalog. Set OTCMS_CACHE to a
+directory outside htdocs to keep them there instead (one directory per site)
 ''')
     sys.exit(2)
 
 
 
+entry_context = dict() # templates and render cache of the current process, for entry pages
+
+
+def template_registry(templates_dir, cache_dir):
+    """All the templates, by file name, resolved once
+
+    Templates are compiled to python modules in the cache directory, which
+    are reused by all processes and runs as long as the templates do not change.
+    """
+    from mako.lookup import TemplateLookup
+    lookup = TemplateLookup(directories=[templates_dir], module_directory=join(cache_dir, "mako"),
+                            output_encoding='utf-8', encoding_errors='replace')
+    templates = dict()
+    for fname in sorted(os.listdir(templates_dir)):
+        if os.path.isfile(join(templates_dir, fname)):
+            templates[fname] = lookup.get_template(fname)
+    return templates
+
+
+def init_entry_context(templates_dir, cache_dir, htdocs):
+    """Setup the templates and render cache for rendering entries in this process"""
+    entry_context["templates"] = template_registry(templates_dir, cache_dir)
+    entry_context["render_cache"] = otCMS.otCMSRenderCache(join(cache_dir, "markdown"))
+    entry_context["writer"] = otCMS.otCMSWriter(htdocs)
+    entry_context["htdocs"] = htdocs
+
+
+def render_entry(job):
+    """Generate the page (and meta.rdf) of an entry
+
+    Returns digests of the page and meta.rdf, the render cache hits and misses,
+    the writer counters and the timings (see otCMS.otCMSProfile) of this job.
+    """
+    started = time.perf_counter(), time.process_time()
+    entry, previous_html_block, next_html_block, nearby_html_block, source, dest, rdf, source_digest = job
+    templates = dict()
+    mytemplates = otCMS.timedTemplates(entry_context["templates"], templates)
+    render_cache = entry_context["render_cache"]
+    writer = entry_context["writer"]
+    htdocs = entry_context["htdocs"]
+    hits, misses, writer_counters = render_cache.hits, render_cache.misses, writer.counters()
+
+    mytemplate = mytemplates["prevnext.html"]
+    if entry.year == None: # for contact page etc, non-dated stuff; no need for that nav
+        prevnext_html = ''
+    else:
+        prevnext_html = mytemplate.render_unicode(
+                                    previous_body= previous_html_block,
+                                    next_body= next_html_block,
+                                    page_language = entry.language
+                                    )
+
+    mytemplate = mytemplates["nearby.html"]
+    nearby_html = ''
+    if nearby_html_block:
+        nearby_html = mytemplate.render_unicode(
+                                        nearby_body = nearby_html_block,
+                                        page_language = entry.language
+                                        )
+
+    markdown_started = time.perf_counter(), time.process_time()
+    page_html = render_cache.render(join(htdocs, source), source_digest)
+    markdown = [time.perf_counter()-markdown_started[0], time.process_time()-markdown_started[1]]
+    mytemplate = mytemplates["page.html"]
+    clean_abstract = ''
+    if entry.abstract:
+        clean_abstract = tag_re.sub('', entry.abstract)
+        clean_abstract = re.sub('[<>]', '', clean_abstract)
+    page_digest = writer.write(dest, mytemplate.render_unicode(
+                                    body= page_html,
+                                    title= entry.title,
+                                    page_type="Page",
+                                    page_description = clean_abstract,
+                                    page_language = entry.language,
+                                    prevnext_body = prevnext_html,
+                                    nearby_body = nearby_html
+                                    ))
+
+    rdf_digest = None
+    if rdf:
+        mytemplate = mytemplates["meta.rdf"]
+        rdf_digest = writer.write(rdf, mytemplate.render_unicode(
+                                        uri= entry.uri,
+                                        title= entry.title) )
+
+    writer_counters = [after - before for before, after in zip(writer_counters, writer.counters())]
+    timings = {"entry": [time.perf_counter()-started[0], time.process_time()-started[1]],
+               "markdown": markdown, "templates": templates}
+    return page_digest, rdf_digest, render_cache.hits - hits, render_cache.misses - misses, writer_counters, timings
+
+
 def main(argv=None):
     private = False
+    incremental = False
+    jobs = 1
+    watch = False
+    feed_options = {"size": 49, "all": False, "rss": False}
+    compress = False
+    picks = {"seed": None, "rotate": 0}
+    search_options = {"index": False, "bodies": False}
+    profiling = False
+    profile_json = None
+    profile_pstats = None
     catalog_path =  realpath(os.path.curdir) # by default
     htdocs = None
     catalog = None
@@ -62,7 +220,7 @@ def main(argv=None):
         argv = sys.argv
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hp", ["help", "catalog=", "htdocs="])
+            opts, args = getopt.getopt(argv[1:], "hp", ["help", "catalog=", "htdocs=", "incremental", "jobs=", "watch", "feeds", "rss", "feed-size=", "compress", "search", "search-bodies", "seed=", "rotate=", "profile", "profile-json=", "profile-pstats="])
         except getopt.error as msg:
             usage()
 
@@ -78,6 +236,38 @@ def main(argv=None):
                 catalog = value
             if option == "--htdocs":
                 htdocs = realpath(value)
+            if option == "--incremental":
+                incremental = True
+            if option == "--watch":
+                watch = True
+            if option == "--compress":
+                compress = True
+            if option == "--search":
+                search_options["index"] = True
+            if option == "--search-bodies":
+                search_options["bodies"] = True
+            if option == "--seed":
+                picks["seed"] = value
+            if option == "--rotate":
+                picks["rotate"] = max(0, float(value))
+            if option == "--profile":
+                profiling = True
+            if option == "--profile-json":
+                profiling = True
+                profile_json = value
+            if option == "--profile-pstats":
+                profiling = True
+                profile_pstats = value
+            if option == "--feeds":
+                feed_options["all"] = True
+            if option == "--rss":
+                feed_options["rss"] = True
+            if option == "--feed-size":
+                feed_options["size"] = max(1, int(value))
+            if option == "--jobs":
+                jobs = int(value)
+                if jobs < 1:
+                    jobs = os.cpu_count() or 1
 
     except Exception as e:
         print(e)
@@ -113,9 +303,15 @@ def main(argv=None):
             print(e)
             usage()
 
+    profile = otCMS.otCMSProfile()
+    if profile_pstats:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
     try:
-        entries = otCMS.otCMSCatalog()
-        entries.fromfile(catalog)
+        with profile.stage("catalog"):
+            entries = otCMS.otCMSCatalog()
+            entries.fromfile(catalog)
         print("Catalog read successfully. %d entries loaded" % len(entries))
     except Exception as e:
         print(e)
@@ -131,282 +327,441 @@ def main(argv=None):
         htdocs=catalog_path
     print("Writing files with %s as htdocs root directory" % htdocs)
 
-    # Setup template engine, path is known relative to the script
-    from mako.template import Template
-    from mako.lookup import TemplateLookup
-    mylookup = TemplateLookup(directories=[join(dirname(__file__), "..", "templates")], output_encoding='utf-8', encoding_errors='replace')
-    selection_template = mylookup.get_template("list_entry.html") # template for list of entries, used throughout
+    options = {"private": private, "incremental": incremental, "jobs": jobs, "compress": compress,
+               "feeds": feed_options, "picks": picks, "search": search_options}
+    state = dict()
+    try:
+        refresh(entries, catalog, htdocs, options, state=state, profile=profile)
+        if profile_pstats:
+            profiler.disable()
+            profiler.dump_stats(profile_pstats)
+        if profiling:
+            print(profile.report())
+        if profile_json:
+            with open(profile_json, "w") as profile_fh:
+                json.dump(profile.todict(), profile_fh, indent=2, sort_keys=True)
+        if watch:
+            watch_and_refresh(entries, catalog, htdocs, options, state)
+    finally:
+        if "executor" in state:
+            state["executor"].shutdown()
+
+
+def watched_files(entries, catalog, htdocs):
+    """mtimes of the catalog, MarkDown sources and templates a build depends on"""
+    mtimes = dict()
+    watched = [catalog] + [join(htdocs, entry.paths()[0]) for entry in entries]
+    watched = watched + [join(TEMPLATES_DIR, fname) for fname in os.listdir(TEMPLATES_DIR)]
+    for fname in watched:
+        try:
+            mtimes[fname] = os.stat(fname).st_mtime_ns
+        except OSError:
+            mtimes[fname] = None
+    return mtimes
 
 
+def watch_and_refresh(entries, catalog, htdocs, options, state, interval=0.5):
+    """Poll the sources of the site, and refresh incrementally whenever one changes"""
+    print("Watching %s, its sources and templates for changes. Ctrl-C to stop" % catalog)
+    mtimes = watched_files(entries, catalog, htdocs)
+    try:
+        while True:
+            time.sleep(interval)
+            new_mtimes = watched_files(entries, catalog, htdocs)
+            if new_mtimes == mtimes:
+                continue
+            changed = [fname for fname in new_mtimes if new_mtimes[fname] != mtimes.get(fname)]
+            print("Changed: %s" % ", ".join(sorted(changed)))
+            started = time.time()
+            try:
+                if mtimes.get(catalog) != new_mtimes[catalog]:
+                    entries = otCMS.otCMSCatalog()
+                    entries.fromfile(catalog)
+                    print("Catalog read successfully. %d entries loaded" % len(entries))
+                refresh(entries, catalog, htdocs, dict(options, incremental=True), state=state)
+            except Exception as e:
+                # e.g. a catalog being edited; keep watching until it is fixed
+                print("Error: %s" % e)
+            print("Refreshed in %.3fs" % (time.time()-started))
+            # files saved during the build are still to be seen as changed: only the files
+            # watched since the build (e.g. sources of new entries) get their current mtime
+            mtimes = dict((fname, new_mtimes.get(fname, mtime)) for fname, mtime in watched_files(entries, catalog, htdocs).items())
+    except KeyboardInterrupt:
+        pass
+
+
+def sized_images(body, media_index):
+    """add the height matching width="600" to the images of an Atom entry the media index knows"""
+    def add_height(match):
+        size = media_index.size(match.group(2))
+        if not size or not size[0]:
+            return match.group(0)
+        return '<img width="600" height="%d" src="%s/%s"' % (round(600.0*size[1]/size[0]), match.group(1), match.group(2))
+    if not media_index.images:
+        return body
+    return atom_sized_img_re.sub(add_height, body)
+
+
+def atom_body(body, entry_id, media_index):
+    """rewrite the rendered body of an entry for the Atom feed"""
+    def absolute_src(match):
+        # photos are replaced by their big thumbnails
+        return 'src="'+entry_id+("tn" if match.group(1) == "tn" else "tn/lg_"+match.group(1))
+    body = atom_src_re.sub(absolute_src, body)
+    body = atom_link_re.sub('\\1', body)
+    body = atom_lazy_img_re.sub('', body)
+    body = atom_img_re.sub('<img width="600" src', body)
+    body = sized_images(body, media_index)
+    body = atom_noscript_re.sub('\\1', body)
+    body = atom_caption_re.sub("<img\\1/img><p><i>\\2</i></p>", body)
+    body = atom_caption_closed_re.sub("<img\\1 /><p><i>\\2</i></p>", body)
+    return body
+
+
+def site_feeds(entries, catalog_index, feed_options):
+    """the feeds of the site, each with its paths, title, links and entries
+
+    Feeds only list dated entries. Only the main feed, unless feed_options["all"]
+    is set: then also paged archives of all entries (RFC 5005), and feeds per
+    language, year and location.
+    """
+    size = feed_options["size"]
+    # undated pages (e.g. contact) are not in feeds: feedgen would date them at build time
+    main_feed = dict(MAIN_FEED, entries=[entry for entry in entries if entry.pubdate != None][0:size], links=[])
+    feeds = [main_feed]
+    if not feed_options["all"]:
+        return feeds
+
+    # archive pages are counted from the oldest entry, so they do not change when entries are added
+    dated = sorted([entry for entry in entries if entry.pubdate != None], key=lambda entry: entry.pubdate)
+    pages = len(dated) // size
+    for page in range(1, pages+1):
+        links = [("current", "atom.xml")]
+        if page > 1:
+            links.append(("prev-archive", "archives/%d.xml" % (page-1)))
+        if page < pages:
+            links.append(("next-archive", "archives/%d.xml" % (page+1)))
+        feeds.append({"atom": "archives/%d.xml" % page, "rss": None, "id": "/archives/%d" % page,
+                      "title": "Archives, page %d" % page, "alternate": "/all.html", "links": links, "archive": True,
+                      "entries": list(reversed(dated[(page-1)*size:page*size]))})
+    if pages > 0:
+        main_feed["links"].append(("prev-archive", "archives/%d.xml" % pages))
+
+    for lang in sorted(set(entry.language for entry in entries if entry.language)):
+        feeds.append({"atom": "atom_%s.xml" % lang, "rss": "rss_%s.xml" % lang, "id": "/"+lang,
+                      "title": LANGUAGE_TITLES.get(lang, lang),
+                      "alternate": "/all_%s.html" % lang if lang in LANGUAGE_TITLES else "/all.html", "links": [], "archive": False,
+                      "entries": [entry for entry in entries if entry.language == lang and entry.pubdate != None][0:size]})
+    for year in catalog_index.years:
+        feeds.append({"atom": "%s/atom.xml" % year, "rss": "%s/rss.xml" % year, "id": "/%s" % year,
+                      "title": str(year), "alternate": "/%s/" % year, "links": [], "archive": False,
+                      "entries": catalog_index.yearly_selection[year][0:size]})
+    for loc_name in catalog_index.locations:
+        loc = re.sub (" ", "_", loc_name.lower())
+        loc = re.sub (",", "", loc)
+        feeds.append({"atom": "geo/%s.xml" % loc, "rss": "geo/%s.rss" % loc, "id": "/geo/"+loc,
+                      "title": catalog_index.location_types[loc_name]+": "+loc_name, "alternate": "/geo/%s.html" % loc,
+                      "links": [], "archive": False,
+                      "entries": [entry for entry in catalog_index.loc_selection[loc_name] if entry.pubdate != None][0:size]})
+    return feeds
+
+
+def atom_feed(feed, updated=None):
+    """feedgen generator for an Atom feed of the site, without entries"""
+    from feedgen.feed import FeedGenerator
+    fg = FeedGenerator()
+    fg.id('tag:olivier.thereaux.net,2000:1337'+feed["id"])
+    fg.title('2 Neurones and 1 Camera'+(": "+feed["title"] if feed["title"] else ''))
+    # fg.author( {'name':'Olivier Thereaux','uri':'https://olivier.thereaux.net/contact'} )
+    fg.author( {'name':'Olivier Thereaux'} )
+    fg.link( href='https://olivier.thereaux.net'+feed["alternate"], rel='alternate' )
+    fg.subtitle('Olivier Thereaux')
+    fg.link( href='https://olivier.thereaux.net/'+feed["atom"], rel='self' )
+    for rel, path in feed["links"]:
+        fg.link( href='https://olivier.thereaux.net/'+path, rel=rel )
+    if updated:
+        fg.updated(updated)
+    return fg
+
+
+def rss_feed(feed, updated=None):
+    """feedgen generator for an RSS feed of the site, without entries"""
+    from feedgen.feed import FeedGenerator
+    fg = FeedGenerator()
+    fg.title('2 Neurones and 1 Camera'+(": "+feed["title"] if feed["title"] else ''))
+    # feedgen uses the last link as the <link> of the channel
+    fg.link( href='https://olivier.thereaux.net/'+feed["rss"], rel='self' )
+    fg.link( href='https://olivier.thereaux.net'+feed["alternate"], rel='alternate' )
+    fg.description('Olivier Thereaux')
+    if updated:
+        fg.lastBuildDate(updated)
+    return fg
+
+
+def feed_head_xml(feed, updated, feed_format):
+    """a feed (Atom or RSS), up to its first entry"""
+    if feed_format == "rss":
+        rss_xml = rss_feed(feed, updated).rss_str(pretty=True).decode("utf-8")
+        return rss_xml[:rss_xml.rindex("  </channel>")]
+    atom_xml = atom_feed(feed, updated).atom_str(pretty=True).decode("utf-8")
+    atom_head = atom_xml[:atom_xml.rindex("</feed>")]
+    if feed["archive"]:
+        # RFC 5005 archive documents are marked as such
+        atom_head = atom_head.replace('<feed xmlns="http://www.w3.org/2005/Atom">',
+                                      '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:fh="http://purl.org/syndication/history/1.0">', 1)
+        atom_head = atom_head + "  <fh:archive/>\n"
+    return atom_head
+
+
+def feed_entry_xml(entry, render_cache, htdocs, media_index, feed_format):
+    """the <entry> (Atom) or <item> (RSS) element of an entry, as in any feed of the site"""
+    fg = rss_feed(MAIN_FEED) if feed_format == "rss" else atom_feed(MAIN_FEED)
+    fe = fg.add_entry()
+    fe.updated(entry.pubdate)
+    entry_id = "https://olivier.thereaux.net"+entry.uri
+    fe.published(entry.pubdate)
+    fe.id(entry_id)
+    fe.author( {'name':'Olivier Thereaux'} )
+    entry_link = {"rel": "alternate", "type":"text/html", "href": "https://olivier.thereaux.net"+entry.uri}
+    fe.link(entry_link)
+    fe.title(entry.title)
+
+    if entry.abstract:
+        fe.summary(entry.abstract)
+    if entry.abstract:
+        entry_content = '<p>%s</p>' % entry.abstract
+        if entry.language == "fr":
+            if entry.photos != None:
+                entry_content =entry_content +'<p><a href="%s">À suivre / %s photos</a></p>' % (entry_id, entry.photos)
+            else:
+                entry_content =entry_content +'<p><a href="%s">À suivre</a></p>' % entry_id
+        else:
+            if entry.photos != None:
+                entry_content =entry_content +'<p><a href="%s">À suivre / %s photos</a></p>' % (entry_id, entry.photos)
+            else:
+                entry_content =entry_content +'<p><a href="%s">À suivre</a></p>' % entry_id
+        if entry.thumbnail:
+            entry_thumbnail_big = entry.thumbnail
+            entry_thumbnail_big = re.sub("tn/tn_", "tn/lg_", entry.thumbnail)
+            entry_content =entry_content +'<img src="https://olivier.thereaux.net%s" width="500px" height="500px" />' % entry_thumbnail_big
+        fe.content(entry_content, type="html")
+
+    # bodies are not kept on entries, they are fetched from the render cache
+    body = render_cache.render(join(htdocs, entry.paths()[0]))
+    fe.content(atom_body(body, entry_id, media_index),type="html")
+    if feed_format == "rss":
+        rss_xml = fg.rss_str(pretty=True).decode("utf-8")
+        return rss_xml[rss_xml.index("    <item>"):rss_xml.rindex("  </channel>")]
+    atom_xml = fg.atom_str(pretty=True).decode("utf-8")
+    return atom_xml[atom_xml.index("  <entry>"):atom_xml.rindex("</feed>")]
+
+
+def write_output(job):
+    """write a generated file with a writer of its own, so that files can be written in threads"""
+    htdocs, output, text = job
+    writer = otCMS.otCMSWriter(htdocs)
+    return writer.write(output, text), writer.counters()
+
+
+def default_options():
+    """the options of a build, as refresh() takes them"""
+    return {"private": False, "incremental": False, "jobs": 1, "compress": False,
+            "feeds": {"size": 49, "all": False, "rss": False},
+            "picks": {"seed": None, "rotate": 0},
+            "search": {"index": False, "bodies": False}}
+
+
+def refresh(entries, catalog, htdocs, options=None, state=None, profile=None):
+    """Generate entries, indexes and feeds for a catalog
+
+    options is a dict of build options, see default_options for their defaults:
+    options["feeds"] selects the feeds to generate, see site_feeds. With
+    options["compress"], generated files get .gz (and .br) siblings, see
+    otCMS.otCMSCompressor. With an options["picks"]["seed"], nearby and home
+    page entries are picked from that seed (and the current period of
+    options["picks"]["rotate"] days) rather than at random. options["search"]["index"]
+    adds a search index, of entry bodies too with options["search"]["bodies"],
+    see otCMS.otCMSSearchIndex.
+    state keeps the manifest, template engine and caches between calls,
+    so that a long-lived process (see --watch) only pays for them once.
+    The time spent in each stage is recorded in profile, see otCMS.otCMSProfile.
+    """
+    build_options = default_options()
+    build_options.update(options or dict())
+    private = build_options["private"]
+    incremental = build_options["incremental"]
+    jobs = build_options["jobs"]
+    compress = build_options["compress"]
+    feed_options = build_options["feeds"]
+    picks = build_options["picks"]
+    search_options = build_options["search"]
+    if state is None:
+        state = dict()
+    if profile is None:
+        profile = otCMS.otCMSProfile()
+    profile.begin("setup")
+    # the same seed and period pick the same entries, whatever the run
+    pick_seed = None
+    if picks["seed"] != None:
+        pick_seed = (picks["seed"], int(time.time() // (picks["rotate"]*86400)) if picks["rotate"] else 0)
+    cache_dir = otCMS.siteCacheDir(dirname(catalog))
+
+    # The manifest remembers what each generated file was built from.
+    # It is always kept up to date, but only used to skip work with --incremental
+    if "manifest" not in state:
+        catalog_name = re.sub(r"\.py$", "", os.path.basename(catalog))
+        state["manifest"] = otCMS.otCMSManifest(join(cache_dir, catalog_name+".manifest.json"), htdocs)
+        if incremental:
+            state["manifest"].load()
+    manifest = state["manifest"]
+    manifest.rebuilt = 0
+
+    # all files are written atomically, and only if their content changed
+    writer = otCMS.otCMSWriter(htdocs)
+
+    # MarkDown bodies are only ever rendered once for a given source
+    render_cache = otCMS.otCMSRenderCache(join(cache_dir, "markdown"))
+
+    # image dimensions, if bin/mediaindex.py has indexed htdocs
+    media_index = otCMS.otCMSMediaIndex(htdocs).load()
+
+    # Setup template engine, path is known relative to the script
+    templates_dir = TEMPLATES_DIR
+    templates_digest = manifest.templates_digest(templates_dir)
+    if state.get("templates_digest") != templates_digest:
+        state["templates"] = template_registry(templates_dir, cache_dir)
+        # template for list of entries, used throughout. Each entry of a list is only rendered once
+        state["snippets"] = otCMS.otCMSSnippets(state["templates"]["list_entry.html"])
+        state["templates_digest"] = templates_digest
+    mytemplates = profile.timed(state["templates"])
+    snippets = state["snippets"]
+    snippets.template = mytemplates["list_entry.html"]
+    snippets_hits, snippets_misses = snippets.hits, snippets.misses
+
+
+    # Date and location indexes, neighbours and search terms of each entry, see otCMSIndex
+    profile.begin("index")
+    catalog_index = otCMS.otCMSIndex(entries, search=search_options["index"] and private == False)
+
     # 1.  Preparation for date-based archives / index
-    years = list() # list of all years where there are entries
-    yearly_selection = dict() # dict of entries per year
+    profile.begin("archive lists")
+    years = catalog_index.years # list of all years where there are entries
+    yearly_selection = catalog_index.yearly_selection # dict of entries per year
     yearly_all_html = '' # html block with all entries, per year
     yearly_selection_html = dict() # dictionary of html block, per year
-    yearly_lang_selection = dict()
-    yearly_lang_selection['en'] = dict()
-    yearly_lang_selection['fr'] = dict()
+    yearly_lang_selection = catalog_index.yearly_lang_selection
     yearly_lang_html = dict()
     yearly_lang_html['en'] = ''
     yearly_lang_html['fr'] = ''
 
-    for entry in entries:
-        if entry.year != None:
-            if entry.year not in years:
-                years.append(entry.year)
-                yearly_selection[entry.year] = list()
-                yearly_lang_selection['en'][entry.year] = list()
-                yearly_lang_selection['fr'][entry.year] = list()
-            yearly_selection[entry.year].append(entry)
-            yearly_lang_selection[entry.language][entry.year].append(entry)
-    for year in years:
-        yearly_all_html = yearly_all_html + '''<h2 id="y%(year)s">%(year)s</h2>''' % {"year": year}
-        yearly_selection_html[year] = selection_template.render_unicode(selection = yearly_selection[year])
-        yearly_all_html = yearly_all_html + selection_template.render_unicode(selection = yearly_selection[year])
-        if year in yearly_lang_selection['en']:
-            if len(yearly_lang_selection['en'][year]) > 0:
-                yearly_lang_html['en'] = yearly_lang_html['en'] + '''<h2 id="y%(year)s">%(year)s</h2>''' % {"year": year}
-                yearly_lang_html['en'] = yearly_lang_html['en']+ selection_template.render_unicode(selection = yearly_lang_selection['en'][year])
-        if year in yearly_lang_selection['fr']:
-            if len(yearly_lang_selection['fr'][year]) > 0:
-                yearly_lang_html['fr'] = yearly_lang_html['fr'] + '''<h2 id="y%(year)s">%(year)s</h2>''' % {"year": year}
-                yearly_lang_html['fr'] = yearly_lang_html['fr']+ selection_template.render_unicode(selection = yearly_lang_selection['fr'][year])
+    # the full archives only need rendering if one of the dated entries changed
+    archives_key = otCMS.makeDigest(templates_digest, [entry.digest() for entry in entries if entry.year != None])
+    archives_stale = dict()
+    for filename in ['all.html', 'all_en.html', 'all_fr.html']:
+        archives_stale[filename] = not (incremental and manifest.is_fresh(filename, archives_key))
+    if private == False and True in archives_stale.values():
+        for year in years:
+            yearly_all_html = yearly_all_html + '''<h2 id="y%(year)s">%(year)s</h2>''' % {"year": year}
+            yearly_all_html = yearly_all_html + snippets.render(yearly_selection[year])
+            if year in yearly_lang_selection['en']:
+                if len(yearly_lang_selection['en'][year]) > 0:
+                    yearly_lang_html['en'] = yearly_lang_html['en'] + '''<h2 id="y%(year)s">%(year)s</h2>''' % {"year": year}
+                    yearly_lang_html['en'] = yearly_lang_html['en']+ snippets.render(yearly_lang_selection['en'][year])
+            if year in yearly_lang_selection['fr']:
+                if len(yearly_lang_selection['fr'][year]) > 0:
+                    yearly_lang_html['fr'] = yearly_lang_html['fr'] + '''<h2 id="y%(year)s">%(year)s</h2>''' % {"year": year}
+                    yearly_lang_html['fr'] = yearly_lang_html['fr']+ snippets.render(yearly_lang_selection['fr'][year])
 
     # 2. Preparation for location based archives / index
-    locations = list() # list of all locations. Should be alphabetically sorted
-    location_types = dict() # dictionary of all locations per type (Continent, Country, etc)
-    loc_selection = dict()  # dictionary of entries, per location
+    locations = catalog_index.locations # list of all locations, alphabetically sorted
+    location_types = catalog_index.location_types # type of each location (Continent, Country, etc)
+    loc_selection = catalog_index.loc_selection  # dictionary of entries, per location
     loc_selection_html = dict() # HTML output
 
-    for entry in entries:
-        # this is a bit of a dance in order to make the catalog flexible.
-        # it is possible for each catalog entry to have (or not have) values
-        # for Continent, Country, State, Region, City or Location
-        # and each of these may either be a string or a list
-        if entry.continent != None:
-            continents = list()
-            if type(entry.continent) != type(list()):
-                continents.append(entry.continent)
-            else:
-                continents = entry.continent
-            for continent in continents:
-                if continent not in locations:
-                    locations.append(continent)
-                    location_types[continent] = "Continent"
-                    loc_selection[continent] = list()
-                loc_selection[continent].append(entry)
-        if entry.country != None:
-            countries = list()
-            if type(entry.country) != type(list()):
-                countries.append(entry.country)
-            else:
-                countries = entry.country
-            for country in countries:
-                if country not in locations:
-                    locations.append(country)
-                    location_types[country] = "Country"
-                    loc_selection[country] = list()
-                loc_selection[country].append(entry)
-        if entry.city != None:
-            cities = list()
-            if type(entry.city) != type(list()):
-                cities.append(entry.city)
-            else:
-                cities = entry.city
-            for city in cities:
-                if city not in locations:
-                    locations.append(city)
-                    location_types[city] = "City"
-                    loc_selection[city] = list()
-                loc_selection[city].append(entry)
-        if entry.state != None:
-            states = list()
-            if type(entry.state) != type(list()):
-                states.append(entry.state)
-            else:
-                states = entry.state
-            for state in states:
-                if state not in locations:
-                    locations.append(state)
-                    location_types[state] = "State"
-                    loc_selection[state] = list()
-                loc_selection[state].append(entry)
-        if entry.region != None:
-            regions = list()
-            if type(entry.region) != type(list()):
-                regions.append(entry.region)
-            else:
-                regions = entry.region
-            for region in regions:
-                if region not in locations:
-                    locations.append(region)
-                    location_types[region] = "Region"
-                    loc_selection[region] = list()
-                loc_selection[region].append(entry)
-        if entry.location != None:
-            locs = list()
-            if type(entry.location) != type(list()):
-                locs.append(entry.location)
-            else:
-                locs = entry.location
-            for loc in locs:
-                if loc not in locations:
-                    locations.append(loc)
-                    location_types[loc] = "Location"
-                    loc_selection[loc] = list()
-                loc_selection[loc].append(entry)
-    locations.sort()
-
     # 3. Generate individual entries from their MarkDown source
-    for entry in entries:
-        i=entries.index(entry)
-        previous = entries[i-1] if i>0 else None
-        # ignoring non-dated entry pages
-        if previous:
-            if previous.year == None:
-                previous = None
-        next = entries[i+1] if i<len(entries)-1 else None
-        # ignoring non-dated entry pages
-        if next:
-            if next.year == None:
-                next = None
-
-        previous_html_block = selection_template.render_unicode(selection = [previous]) if previous else ''
-        next_html_block = selection_template.render_unicode(selection = [next]) if next else ''
-        mytemplate = mylookup.get_template("prevnext.html")
-        if entry.year == None: # for contact page etc, non-dated stuff; no need for that nav
-            prevnext_html = ''
-        else:
-            prevnext_html = mytemplate.render_unicode(
-                                        previous_body= previous_html_block,
-                                        next_body= next_html_block,
-                                        page_language = entry.language
-                                        )
-
-        mytemplate = mylookup.get_template("nearby.html")
-        nearby_list = list()
-        if entry.city != None:
-            try:
-                nearby_list= nearby_list+loc_selection[entry.city]
-                nearby_list = sorted(set(nearby_list))
-                nearby_list.remove(entry)
-            except:
-                pass
-        if entry.state != None and len(nearby_list) < 5:
-            try:
-                nearby_list= nearby_list+loc_selection[entry.state]
-                nearby_list = sorted(set(nearby_list))
-                nearby_list.remove(entry)
-            except:
-                pass
-        if entry.region != None and len(nearby_list) < 5:
-            try:
-                nearby_list= nearby_list+loc_selection[entry.region]
-                nearby_list = sorted(set(nearby_list))
-                nearby_list.remove(entry)
-            except:
-                pass
-        if entry.country != None and len(nearby_list) < 5:
-            try:
-                nearby_list= nearby_list+loc_selection[entry.country]
-                nearby_list = sorted(set(nearby_list))
-                nearby_list.remove(entry)
-            except:
-                pass
-        # After a bit of experimentation, going beyond Country feels to broad
-        # if entry.continent != None and len(nearby_list) < 3:
-        #     try:
-        #         nearby_list= nearby_list+loc_selection[entry.continent]
-        #         nearby_list = sorted(set(nearby_list))
-        #         nearby_list.remove(entry)
-        #     except:
-        #         pass
-        if len(nearby_list)> 0:
-            nearby_list_dedup = list()
-            nearby_list_dedup_index = list()
-            for nearby_entry in nearby_list:
-                if nearby_entry.uri == entry.uri:
-                    pass
-                elif nearby_entry.uri in nearby_list_dedup_index:
-                    pass
-                else:
-                    nearby_list_dedup_index.append(nearby_entry.uri)
-                    nearby_list_dedup.append(nearby_entry)
-            nearby_list = nearby_list_dedup
-        if len(nearby_list)>5:
-            nearby_list=random.sample(nearby_list, 5)
-
-        nearby_html_block = selection_template.render_unicode(selection = nearby_list) if len(nearby_list)>0 else ''
-        nearby_html = ''
-        if nearby_list:
-            nearby_html = mytemplate.render_unicode(
-                                            nearby_body = nearby_html_block,
-                                            page_language = entry.language
-                                            )
-
-
-        source = entry.uri
-        source = re.sub(r"^/", "", source)
-        if re.search(r".*\.html$", source):
-            dest = source
-            source = re.sub(r"\.html$", ".md", source)
-        elif re.search(r".*/$", source):
-            dest = re.sub(r"$", "index.html", source)
-            source = re.sub(r"$", "index.md", source)
-        else:
-            dest = source+".html"
-            source = source+".md"
-        source_fn = join(htdocs, source)
-        page_html = markdown2.markdown_path(source_fn)
-        page_html = page_html.replace("<p></div></p>", "</div>") # workaround for annoying markdown behavior
-        entry.body = page_html
-        dest_fn = join(htdocs, dest)
-        dest_fh = open(dest_fn, "w")
-        mytemplate = mylookup.get_template("page.html")
-        tag_re = re.compile(r'(<!--.*?-->|<[^>]*>)')
-        clean_abstract = ''
-        if entry.abstract:
-            clean_abstract = tag_re.sub('', entry.abstract)
-            clean_abstract = re.sub('[<>]', '', clean_abstract)
-        dest_fh.write( mytemplate.render_unicode(
-                                        body= page_html,
-                                        title= entry.title,
-                                        page_type="Page",
-                                        page_description = clean_abstract,
-                                        page_language = entry.language,
-                                        prevnext_body = prevnext_html,
-                                        nearby_body = nearby_html
-                                        ))
-        dest_fh.close()
-
-        if re.search(r"index", source):
-            rdf = re.sub(r"index\..*", "", source)+"meta.rdf"
-            rdf_fn = join(htdocs, rdf)
-            rdf_fh = open(rdf_fn, "w")
-            mytemplate = mylookup.get_template("meta.rdf")
-            rdf_fh.write( mytemplate.render_unicode(
-                                            uri= entry.uri,
-                                            title= entry.title) )
-            rdf_fh.close()
+    profile.begin("entry pages")
+    entry_jobs = list()
+    entry_keys = list()
+    for i, entry in enumerate(entries):
+        previous, next = catalog_index.neighbours[i]
+
+        nearby_list = catalog_index.nearby[i]
+
+        # skip the entry if neither it, its source, nor its neighbours changed
+        source, dest = entry.paths()
+        page_key = otCMS.makeDigest(templates_digest, entry.digest(), manifest.source_digest(source),
+                                    previous.digest() if previous else None,
+                                    next.digest() if next else None,
+                                    [nearby_entry.digest() for nearby_entry in nearby_list],
+                                    pick_seed if len(nearby_list) > otCMS.NEARBY_SIZE else None)
+        rdf = re.sub(r"index\..*", "", source)+"meta.rdf" if re.search(r"index", source) else None
+        rdf_key = otCMS.makeDigest(templates_digest, entry.uri, entry.title)
+        if incremental and manifest.is_fresh(dest, page_key):
+            if rdf == None or manifest.is_fresh(rdf, rdf_key):
+                continue
+
+        if len(nearby_list)>otCMS.NEARBY_SIZE:
+            if pick_seed != None:
+                nearby_list=otCMS.seededSample(nearby_list, otCMS.NEARBY_SIZE, pick_seed, entry.uri)
+            else:
+                import random
+                nearby_list=random.sample(nearby_list, otCMS.NEARBY_SIZE)
+
+        previous_html_block = snippets.render([previous]) if previous else ''
+        next_html_block = snippets.render([next]) if next else ''
+        nearby_html_block = snippets.render(nearby_list) if len(nearby_list)>0 else ''
+        entry_jobs.append((entry, previous_html_block, next_html_block, nearby_html_block, source, dest, rdf, manifest.source_digest(source)))
+        entry_keys.append((dest, page_key, rdf, rdf_key))
+
+    # entry pages only depend on their job, so they can be rendered in any process
+    # and the context of a process is only valid for the site and templates it was made for
+    context_key = (templates_digest, htdocs, cache_dir)
+    if entry_context.get("key") != context_key:
+        init_entry_context(templates_dir, cache_dir, htdocs)
+        entry_context["key"] = context_key
+    if jobs > 1 and len(entry_jobs) > 1:
+        if "executor" in state and state["executor_key"] != context_key:
+            # workers made their context when they started
+            state.pop("executor").shutdown()
+        if "executor" not in state:
+            from concurrent.futures import ProcessPoolExecutor
+            state["executor_key"] = context_key
+            state["executor"] = ProcessPoolExecutor(max_workers=jobs, initializer=init_entry_context,
+                                                    initargs=(templates_dir, cache_dir, htdocs))
+        entry_results = list(state["executor"].map(render_entry, entry_jobs, chunksize=max(1, len(entry_jobs)//(jobs*4))))
+    else:
+        entry_results = [render_entry(job) for job in entry_jobs]
+    for (dest, page_key, rdf, rdf_key), (page_digest, rdf_digest, hits, misses, writer_counters, timings) in zip(entry_keys, entry_results):
+        profile.entry(dest, *timings["entry"])
+        otCMS.addTiming(profile.stages, "entry pages: MarkDown", *timings["markdown"])
+        for name, timing in timings["templates"].items():
+            otCMS.addTiming(profile.templates, name, *timing)
+        manifest.record(dest, page_key, page_digest)
+        if rdf:
+            manifest.record(rdf, rdf_key, rdf_digest)
+        render_cache.hits = render_cache.hits + hits
+        render_cache.misses = render_cache.misses + misses
+        writer.add(writer_counters)
 
 
     # 4. Generate archives pages
+    profile.begin("index pages")
 
     if private == False: # do not generate archives and indexes for private entries
 
         # 4.1 Generate full archive
-        mytemplate = mylookup.get_template("index_all.html")
-        index = open(join(htdocs, 'all.html.tmp'), 'w')
-        index.write( mytemplate.render_unicode(
-                                        yearly_entries=yearly_all_html,
-                                        title='Archives',
-                                        page_type="Index",
-                                        page_description = "",
-                                        page_intro = '',
-                                        page_language = "",
-                                        page_include_nav = 1
-                                        ))
-        os.rename(join(htdocs, 'all.html.tmp'), join(htdocs, 'all.html'))
+        if archives_stale['all.html']:
+            mytemplate = mytemplates["index_all.html"]
+            index_html = mytemplate.render_unicode(
+                                            yearly_entries=yearly_all_html,
+                                            title='Archives',
+                                            page_type="Index",
+                                            page_description = "",
+                                            page_intro = '',
+                                            page_language = "",
+                                            page_include_nav = 1
+                                            )
+            manifest.record('all.html', archives_key, writer.write('all.html', index_html))
 
 
 
@@ -419,11 +774,12 @@ def main(argv=None):
 
             filename = "all_"+lang+'.html'
             filename_tmp = "all_"+lang+'.html.tmp'
-            desc_template = mylookup.get_template("intro_"+lang+".html")
+            if not archives_stale[filename]:
+                continue
+            desc_template = mytemplates["intro_"+lang+".html"]
             desc_template.render_unicode()
-            mytemplate = mylookup.get_template("index_all.html")
-            index = open(join(htdocs, filename_tmp), 'w')
-            index.write( mytemplate.render_unicode(
+            mytemplate = mytemplates["index_all.html"]
+            index_html = mytemplate.render_unicode(
                                             yearly_entries=yearly_lang_html[lang],
                                             title= title,
                                             page_type="Index",
@@ -431,29 +787,33 @@ def main(argv=None):
                                             page_intro = desc_template.render_unicode(),
                                             page_language = lang,
                                             page_include_nav = None
-                                            ) )
-            os.rename(join(htdocs, filename_tmp), join(htdocs, filename))
+                                            )
+            manifest.record(filename, archives_key, writer.write(filename, index_html))
 
 
         # 4.2 Generate per-year archive pages
         for year in years:
-            mytemplate = mylookup.get_template("index_generic.html")
-            index = open(join(htdocs, str(year), 'index.html.tmp'), 'w')
-            index.write( mytemplate.render_unicode(
+            year_index = join(str(year), 'index.html')
+            year_key = otCMS.makeDigest(templates_digest, year, [entry.digest() for entry in yearly_selection[year]])
+            if incremental and manifest.is_fresh(year_index, year_key):
+                continue
+            yearly_selection_html[year] = snippets.render(yearly_selection[year])
+            mytemplate = mytemplates["index_generic.html"]
+            index_html = mytemplate.render_unicode(
                                             entries=yearly_selection_html[year],
                                             title='Archives: ' + str(year) ,
                                             page_type="Index",
                                             intro = '',
                                             page_description = "",
                                             page_language = ""
-                                            ) )
-            os.rename(join(htdocs, str(year), 'index.html.tmp'), join(htdocs, str(year), 'index.html'))
+                                            )
+            manifest.record(year_index, year_key, writer.write(year_index, index_html))
 
         # 4.3 Generate main /geo index
         geo_html = ''
         reverse_loc_bytype = dict()
-        geo_index_template = mylookup.get_template("index_generic.html")
-        geo_block_template = mylookup.get_template("list_location.html")
+        geo_index_template = mytemplates["index_generic.html"]
+        geo_block_template = mytemplates["list_location.html"]
 
         for loctype in ['Continent', 'Country', 'Region', 'State', 'City', 'Location']:
             reverse_loc_bytype[loctype] = list()
@@ -465,41 +825,45 @@ def main(argv=None):
             loc_obj.name = loc_name
             loc_obj.count = len(loc_selection[loc_name])
             reverse_loc_bytype[location_types[loc_name]].append(loc_obj)
-        for loctype in ['Continent', 'Country', 'Region', 'State', 'City', 'Location']:
-            geo_html = geo_html + geo_block_template.render_unicode(
-                                            loctype= loctype, locations = reverse_loc_bytype[loctype]
+        geo_key = otCMS.makeDigest(templates_digest, [(loc_name, location_types[loc_name], len(loc_selection[loc_name])) for loc_name in locations])
+        if not (incremental and manifest.is_fresh(join("geo", 'index.html'), geo_key)):
+            for loctype in ['Continent', 'Country', 'Region', 'State', 'City', 'Location']:
+                geo_html = geo_html + geo_block_template.render_unicode(
+                                                loctype= loctype, locations = reverse_loc_bytype[loctype]
+                                                )
+
+            index_html = geo_index_template.render_unicode(
+                                            entries= '',
+                                            title='Archives: Around the world',
+                                            page_type="Index",
+                                            intro = geo_html,
+                                            page_description = "",
+                                            page_language = ""
                                             )
-
-        index = open(join(htdocs, "geo", 'index.html.tmp'), 'w')
-        index.write( geo_index_template.render_unicode(
-                                        entries= '',
-                                        title='Archives: Around the world',
-                                        page_type="Index",
-                                        intro = geo_html,
-                                        page_description = "",
-                                        page_language = ""
-                                        ) )
-        os.rename(join(htdocs, "geo", 'index.html.tmp'), join(htdocs, "geo", 'index.html'))
+            manifest.record(join("geo", 'index.html'), geo_key, writer.write(join("geo", 'index.html'), index_html))
 
         # 4.4 Generate individual geo pages
         for loc_name in locations:
             loc = re.sub (" ", "_", loc_name.lower())
             loc = re.sub (",", "", loc)
-            loc_selection_html[loc] = selection_template.render_unicode(selection = loc_selection[loc_name])
-            mytemplate = mylookup.get_template("index_generic.html")
-            index = open(join(htdocs, "geo", loc+'.html.tmp'), 'w')
-            index.write( mytemplate.render_unicode(
+            loc_key = otCMS.makeDigest(templates_digest, loc_name, location_types[loc_name], [entry.digest() for entry in loc_selection[loc_name]])
+            if incremental and manifest.is_fresh(join("geo", loc+'.html'), loc_key):
+                continue
+            loc_selection_html[loc] = snippets.render(loc_selection[loc_name])
+            mytemplate = mytemplates["index_generic.html"]
+            index_html = mytemplate.render_unicode(
                                             entries= loc_selection_html[loc],
                                             title='Entries in ' + location_types[loc_name] +": "+ loc_name,
                                             page_type="Index",
                                             intro = '',
                                             page_description = "",
                                             page_language = ""
-                                            ) )
-            os.rename(join(htdocs, "geo", loc+'.html.tmp'), join(htdocs, "geo", loc+'.html'))
+                                            )
+            manifest.record(join("geo", loc+'.html'), loc_key, writer.write(join("geo", loc+'.html'), index_html))
 
 
         # 5. Generate the Home Page
+        profile.begin("home page")
 
         latest_selection=entries[0:4]
         entries_featurable = list()
@@ -510,102 +874,121 @@ def main(argv=None):
             if entry.featured != None:
                 if entry.featured == True:
                     entries_spotlight.append(entry)
-            
-        random_selection=random.sample(entries_featurable, 4)
-        latest_selection_html = selection_template.render_unicode(selection = latest_selection)
-        random_selection_html = selection_template.render_unicode(selection = random_selection)
-        spotlight_selection_html = selection_template.render_unicode(selection = entries_spotlight)
-
-        title= "Olivier Thereaux"
-        page_description = 'Travelogue, street photography, a bit of poetry, and the simple pleasure of telling stories. Around the world, from Europe to Japan, from Paris to London via Tokyo and Montreal'
-        page_type = "Home"
-        mytemplate = mylookup.get_template("index_main.html")
-        index = open(join(htdocs, 'index.html.tmp'), 'w')
-
-
-        index.write( mytemplate.render_unicode(
-                                        latest_selection=latest_selection_html,
-                                        random_selection=random_selection_html,
-                                        spotlight_selection=spotlight_selection_html,
-                                        title=title, page_description=page_description,
-                                        page_type=page_type,
-                                        page_language = ""
-                                        ) )
-
-        index.close()
-        os.rename(join(htdocs, 'index.html.tmp'), join(htdocs, 'index.html'))
-
-        # 5. Generate the Atom Feed
-
-        atom_selection=entries[0:49]
-        fg = FeedGenerator()
-        fg.id('tag:olivier.thereaux.net,2000:1337')
-        fg.title('2 Neurones and 1 Camera')
-        # fg.author( {'name':'Olivier Thereaux','uri':'https://olivier.thereaux.net/contact'} )
-        fg.author( {'name':'Olivier Thereaux'} )
-        fg.link( href='https://olivier.thereaux.net/', rel='alternate' )
-        fg.subtitle('Olivier Thereaux')
-        fg.link( href='https://olivier.thereaux.net/atom.xml', rel='self' )
-
-        for entry in atom_selection:
-            fe = fg.add_entry()
-            fe.updated(entry.pubdate)
-            entry_id = "https://olivier.thereaux.net"+entry.uri
-            fe.published(entry.pubdate)
-            fe.id(entry_id)
-            fe.author( {'name':'Olivier Thereaux'} )
-            entry_link = {"rel": "alternate", "type":"text/html", "href": "https://olivier.thereaux.net"+entry.uri}
-            fe.link(entry_link)
-            fe.title(entry.title)
-
-            if entry.abstract:
-                fe.summary(entry.abstract)
-            if entry.abstract:
-                entry_content = '<p>%s</p>' % entry.abstract
-                if entry.language == "fr":
-                    if entry.photos != None:
-                        entry_content =entry_content +'<p><a href="%s">À suivre / %s photos</a></p>' % (entry_id, entry.photos)
-                    else:
-                        entry_content =entry_content +'<p><a href="%s">À suivre</a></p>' % entry_id
-                else:
-                    if entry.photos != None:
-                        entry_content =entry_content +'<p><a href="%s">À suivre / %s photos</a></p>' % (entry_id, entry.photos)
-                    else:
-                        entry_content =entry_content +'<p><a href="%s">À suivre</a></p>' % entry_id
-                if entry.thumbnail:
-                    entry_thumbnail_big = entry.thumbnail
-                    entry_thumbnail_big = re.sub("tn/tn_", "tn/lg_", entry.thumbnail)
-                    entry_content =entry_content +'<img src="https://olivier.thereaux.net%s" width="500px" height="500px" />' % entry_thumbnail_big
-                fe.content(entry_content, type="html")
-
-            entry.body_abs = entry.body
-
-            entry.body = re.sub(r'src="([0-9])', 'src="'+entry_id+'tn/lg_\\1', entry.body, count=0)
-            # entry.body = re.sub(r'src="([0-9])', 'src="'+entry_id+'\\1', entry.body, count=0)
-            entry.body = re.sub(r'src="tn', 'src="'+entry_id+"tn", entry.body, count=0)
-            entry.body = re.compile(r'<a href[^>]*>(.*)</a>', re.MULTILINE).sub('\\1', entry.body, count=0)
-            entry.body = re.sub(r'<img class="lazy".* />', '', entry.body, count=0)
-            entry.body = re.sub(r'<img src', '<img width="600" src', entry.body, count=0)
-            entry.body = re.sub(r'<noscript>(.*)</noscript>', '\\1', entry.body, count=0)
-            entry.body = re.compile('<div class="picCenter picCaption">\s*<img(.*)/img>\s*<p>(.*)</p>\s*</div>', re.MULTILINE).sub("<img\\1/img><p><i>\\2</i></p>",entry.body, count=0)
-            entry.body = re.compile('<div class="picCenter picCaption">\s*<img(.*) />\s*<p>(.*)</p>\s*</div>', re.MULTILINE).sub("<img\\1 /><p><i>\\2</i></p>",entry.body, count=0)
-            fe.content(entry.body,type="html")
-        atom_xml = fg.atom_str(pretty=True).decode("utf-8")
-        # Nasty Hack to add a type=html property to the summary element ...
-        atom_fh = open(join(htdocs, 'atom.xml.tmp'), "w") # Write the ATOM feed to a file
-        atom_fh.write(atom_xml)
-        atom_fh.close()
-        os.rename(join(htdocs, 'atom.xml.tmp'), join(htdocs, 'atom.xml'))
-
-        # rss_xml = fg.rss_str(pretty=True).decode("utf-8")
-        # # Nasty Hack to add a type=html property to the summary element ...
-        # rss_fh = open(join(htdocs, 'rss.xml.tmp'), "w") # Write the ATOM feed to a file
-        # rss_fh.write(rss_xml)
-        # rss_fh.close()
-        # os.rename(join(htdocs, 'rss.xml.tmp'), join(htdocs, 'rss.xml'))
-
-
-        # mytemplate = mylookup.get_template("atom.xml")
+
+        home_key = otCMS.makeDigest(templates_digest, [entry.digest() for entry in entries], pick_seed)
+        if not (incremental and manifest.is_fresh('index.html', home_key)):
+            if pick_seed != None:
+                random_selection=otCMS.seededSample(entries_featurable, 4, pick_seed, "index.html")
+            else:
+                import random
+                random_selection=random.sample(entries_featurable, 4)
+            latest_selection_html = snippets.render(latest_selection)
+            random_selection_html = snippets.render(random_selection)
+            spotlight_selection_html = snippets.render(entries_spotlight)
+
+            title= "Olivier Thereaux"
+            page_description = 'Travelogue, street photography, a bit of poetry, and the simple pleasure of telling stories. Around the world, from Europe to Japan, from Paris to London via Tokyo and Montreal'
+            page_type = "Home"
+            mytemplate = mytemplates["index_main.html"]
+            index_html = mytemplate.render_unicode(
+                                            latest_selection=latest_selection_html,
+                                            random_selection=random_selection_html,
+                                            spotlight_selection=spotlight_selection_html,
+                                            title=title, page_description=page_description,
+                                            page_type=page_type,
+                                            page_language = ""
+                                            )
+            manifest.record('index.html', home_key, writer.write('index.html', index_html))
+
+        # 5. Generate the feeds
+        profile.begin("feeds")
+
+        media_digest = manifest.source_digest(media_index.path)
+        # <entry> and <item> elements are only generated (with feedgen) for new or changed entries,
+        # and shared by all the feeds they appear in
+        if "feed_cache" not in state:
+            state["feed_cache"] = otCMS.otCMSItemCache(join(cache_dir, "feed"))
+        feed_cache = state["feed_cache"]
+        feed_cache.hits, feed_cache.misses = 0, 0
+        feed_formats = ["atom", "rss"] if feed_options["rss"] else ["atom"]
+        feed_jobs = list()
+        feed_keys = dict()
+        feed_outputs = set()
+        # feeds without dated entries are as old as the newest entry, never as the build
+        site_updated = max([entry.pubdate for entry in entries if entry.pubdate] or ["1970-01-01T00:00:00Z"])
+        for feed in site_feeds(entries, catalog_index, feed_options):
+            feed_meta = sorted((key, value) for key, value in feed.items() if key != "entries")
+            feed_sources = [(entry, manifest.source_digest(entry.paths()[0])) for entry in feed["entries"]]
+            for feed_format in feed_formats:
+                output = feed[feed_format]
+                if output == None:
+                    continue
+                feed_outputs.add(output)
+                feed_key = otCMS.makeDigest(feed_format, feed_meta, [(entry.digest(), source_digest) for entry, source_digest in feed_sources], media_digest)
+                if incremental and manifest.is_fresh(output, feed_key):
+                    continue
+                feed_items = list()
+                for entry, source_digest in feed_sources:
+                    item_key = otCMS.makeDigest(feed_format+" entry", entry.digest(), source_digest, media_digest)
+                    feed_items.append(feed_cache.item(item_key, lambda: feed_entry_xml(entry, render_cache, htdocs, media_index, feed_format)))
+                # a feed was last updated when its newest entry was published
+                updated = max([entry.pubdate for entry in feed["entries"] if entry.pubdate] or [site_updated])
+                feed_head = feed_cache.item(otCMS.makeDigest(feed_format+" feed", feed_meta, updated), lambda: feed_head_xml(feed, updated, feed_format))
+                # feedgen lists entries newest last
+                feed_jobs.append((htdocs, output, feed_head + "".join(reversed(feed_items)) + FEED_TAILS[feed_format]))
+                feed_keys[output] = feed_key
+        feed_cache.prune()
+        for output in [output for output in manifest.outputs if feed_output_re.match(output) and output not in feed_outputs]:
+            manifest.remove(output)
+
+        # feeds are written in threads: hashing and writing them is mostly I/O
+        if jobs > 1 and len(feed_jobs) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                feed_results = list(executor.map(write_output, feed_jobs))
+        else:
+            feed_results = [write_output(job) for job in feed_jobs]
+        profile.hits("feed items", feed_cache.hits, feed_cache.misses)
+        for (feed_root, output, feed_text), (digest, counters) in zip(feed_jobs, feed_results):
+            writer.add(counters)
+            manifest.record(output, feed_keys[output], digest)
+        print("Feeds: %d written, from %d cached items and %d generated" % (len(feed_jobs), feed_cache.hits, feed_cache.misses))
+
+        # 5. Generate the search index
+        if search_options["index"]:
+            profile.begin("search index")
+            search_sources = None
+            if search_options["bodies"]:
+                search_sources = [manifest.source_digest(entry.paths()[0]) for entry in entries]
+            search_key = otCMS.makeDigest(otCMS.SEARCH_INDEX_VERSION, [entry.digest() for entry in entries], search_sources)
+            search_outputs = [output for output in manifest.outputs if output.startswith(otCMS.SEARCH_DIR+"/")]
+            if not (incremental and search_outputs and all(manifest.is_fresh(output, search_key) for output in search_outputs)):
+                if search_options["bodies"] and "search_cache" not in state:
+                    # words of each body, tokenized once per source
+                    state["search_cache"] = otCMS.otCMSItemCache(join(cache_dir, "search"))
+                search_index = otCMS.otCMSSearchIndex()
+                for i, entry in enumerate(entries):
+                    body_terms = list()
+                    if search_sources and search_sources[i] != None:
+                        body_terms = state["search_cache"].item(otCMS.makeDigest("search body", search_sources[i]),
+                            lambda: sorted(set(otCMS.searchTerms(render_cache.render(join(htdocs, entry.paths()[0]), search_sources[i])))))
+                    search_index.add(entry, catalog_index.search_terms[i], body_terms)
+                if search_options["bodies"]:
+                    state["search_cache"].prune()
+                search_files = search_index.files()
+                for output, text in search_files:
+                    manifest.record(output, search_key, writer.write(output, text))
+                # shards of words which are no longer used
+                for output in set(search_outputs) - set(output for output, text in search_files):
+                    manifest.remove(output)
+                profile.counters["search terms"] = len(search_index.postings)
+                print("Search index: %d entries, %d words in %d files" % (len(search_index.docs), len(search_index.postings), len(search_files)))
+        else:
+            # like feeds, optional outputs are removed when they are no longer asked for
+            for output in [output for output in manifest.outputs if output.startswith(otCMS.SEARCH_DIR+"/")]:
+                manifest.remove(output)
+
+        # mytemplate = mytemplates["atom.xml"]
         # index = open(join(htdocs, 'atom.xml.tmp'), 'w')
         # latest_pubdate = atom_selection[0].pubdate
         #
@@ -616,5 +999,32 @@ def main(argv=None):
         # index.close()
         # os.rename(join(htdocs, 'atom.xml.tmp'), join(htdocs, 'atom.xml'))
 
+    # 6. Compress what changed, from the digests of all outputs in the manifest
+    if compress:
+        profile.begin("compress")
+        if "compressor" not in state:
+            state["compressor"] = otCMS.otCMSCompressor(htdocs, join(cache_dir, "compressed.json")).load()
+        compressor = state["compressor"]
+        compressor.compress(dict((output, known["digest"]) for output, known in manifest.outputs.items()), jobs)
+        compressor.save()
+        print("Compressed %d files (%s), %d bytes" % (compressor.compressed, ", ".join(compressor.extensions), compressor.bytes_written))
+        profile.counters["compressed files"] = compressor.compressed
+        profile.counters["compressed bytes"] = compressor.bytes_written
+
+    profile.begin("manifest and caches")
+    manifest.save()
+    render_cache.prune()
+    profile.end()
+    otCMS.addTiming(profile.stages, "writing files (in all stages)", writer.seconds, 0.0, writer.written+writer.unchanged)
+    profile.hits("MarkDown render cache", render_cache.hits, render_cache.misses)
+    profile.hits("entry lists", snippets.hits-snippets_hits, snippets.misses-snippets_misses)
+    profile.counters["files written"] = writer.written
+    profile.counters["files unchanged"] = writer.unchanged
+    profile.counters["bytes written"] = writer.bytes_written
+    if incremental:
+        print("Incremental build: %d files regenerated" % manifest.rebuilt)
+    print("MarkDown render cache: %d hits, %d misses" % (render_cache.hits, render_cache.misses))
+    print("Wrote %d files (%d bytes), %d unchanged" % (writer.written, writer.bytes_written, writer.unchanged))
+
 if __name__ == "__main__":
     sys.exit(main())
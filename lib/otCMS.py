@@ -16,11 +16,61 @@ __author__ = "Olivier Thereaux"
 
 import sys
 import os
-import unittest
 import re
-import markdown2
-from os.path import join, dirname, exists
-import ast
+from os.path import join, dirname, exists, realpath
+import json
+import hashlib
+import pickle
+import struct
+import time
+import contextlib
+
+
+CACHE_DIR = ".otcms-cache" # caches are kept in this directory, next to the catalog
+CACHE_ENV = "OTCMS_CACHE" # ... or under the directory this environment variable names, see siteCacheDir
+CATALOG_CACHE_VERSION = 2
+MANIFEST_VERSION = 1
+ITEM_CACHE_VERSION = 2
+COMPRESSED_VERSION = 1
+COMPRESSED_EXTENSIONS = [".gz", ".br"]
+# brotli quality of .br files. 11, brotli's default, is some 20 times slower than 9
+# for a page (and slower than the rest of the build) to save about 15% more
+BROTLI_QUALITY = 9
+# prefix and (square) size of the thumbnails made for each image, in its tn/ directory
+THUMBNAIL_SIZES = [("lg_", 500), ("tn_", 250)]
+IMAGE_SIZES_VERSION = 1
+MEDIA_INDEX_VERSION = 2
+PHOTO_RDF_VERSION = 1
+# elements of a PhotoRDF file used for captions, whatever their namespace prefix
+PHOTO_RDF_FIELDS = ("title", "description", "coverage", "date")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+# JPEG start of frame markers, which carry the dimensions of the image
+JPEG_SOF_MARKERS = set([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+# attribute of otCMSEntry and key in the catalog, for each field of an entry
+ENTRY_FIELDS = [("uri", "URI"), ("title", "Title"), ("thumbnail", "Thumbnail"), ("pubdate", "Pubdate"),
+                ("photos", "Photos"), ("abstract", "Abstract"), ("year", "Year"), ("continent", "Continent"),
+                ("country", "Country"), ("city", "City"), ("region", "Region"), ("state", "State"),
+                ("location", "Location"), ("body", "Body"), ("language", "Language"), ("featured", "Featured")]
+MARKDOWN_EXTRAS = None # extras passed to markdown2, part of the render cache key
+# entry attribute and type for each level of location, in the order they are indexed
+LOCATION_LEVELS = [("continent", "Continent"), ("country", "Country"), ("city", "City"),
+                   ("state", "State"), ("region", "Region"), ("location", "Location")]
+# levels of location searched for nearby entries, closest first.
+# After a bit of experimentation, going beyond Country feels to broad
+NEARBY_LEVELS = ["city", "state", "region", "country"]
+NEARBY_SIZE = 5
+# client-side search index (see otCMSSearchIndex): directory in htdocs, score of a term
+# in each field of an entry, entries per docs file and characters of a term naming its shard
+SEARCH_INDEX_VERSION = 1
+SEARCH_DIR = "search"
+SEARCH_WEIGHTS = {"title": 4, "location": 3, "abstract": 2, "body": 1}
+SEARCH_DOC_FIELDS = ["uri", "title", "year", "language", "thumbnail"]
+SEARCH_DOCS_CHUNK = 1000
+SEARCH_SHARD_PREFIX = 2
+# modules only imported by the stages which need them, and the import time budget
+# of refresh.py --help, in microseconds (see otCMSTests.test_startup)
+STARTUP_LAZY_IMPORTS = ["unittest", "cgi", "ast", "xml.etree.ElementTree", "markdown2", "mako", "feedgen", "lxml", "PIL"]
+STARTUP_BUDGET_US = 150000
 
 
 class otCMS:
@@ -28,41 +78,91 @@ class otCMS:
         pass
 
 
-class otCMSTests(unittest.TestCase):
-    def setUp(self):
-        pass
+def makeDigest(*parts):
+    """stable hexadecimal digest of any literal python values"""
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def siteCacheDir(root):
+    """cache directory of the site whose catalog (or htdocs) is in root
+
+    .otcms-cache in root or, if OTCMS_CACHE is set, a directory per site under it,
+    which keeps the caches out of the published tree.
+    """
+    if os.environ.get(CACHE_ENV):
+        root = realpath(root)
+        return join(os.environ[CACHE_ENV], "%s-%s" % (os.path.basename(root), makeDigest(root)[:12]))
+    return join(root, CACHE_DIR)
+
+
+def findSiteRoot(directory):
+    """root of the site a directory belongs to: the closest directory up with a site cache
+    (a media index or a build manifest, see siteCacheDir), or None"""
+    root = realpath(directory)
+    while True:
+        cache_dir = siteCacheDir(root)
+        if os.path.isdir(cache_dir) and [fname for fname in os.listdir(cache_dir)
+                                         if fname == "media.json" or fname.endswith(".manifest.json")]:
+            return root
+        if root == dirname(root):
+            return None
+        root = dirname(root)
+
+
+def directoryCachePath(directory, fname):
+    """path of a cache file of a directory: in the cache of its site if there is one, as
+    caches have no place in published directories, or else in the directory itself"""
+    root = findSiteRoot(directory)
+    if root == None:
+        return join(directory, CACHE_DIR, fname)
+    return join(siteCacheDir(root), "directories", os.path.relpath(realpath(directory), root), fname)
+
+
+def seededSample(population, k, *seed):
+    """k elements of population, always the same ones for the same population and seed"""
+    import random
+    return random.Random(makeDigest(*seed)).sample(population, k)
+
+
+def fileDigest(fname):
+    """hexadecimal digest of the contents of a file"""
+    digest = hashlib.sha1()
+    with open(fname, "rb") as fh:
+        for chunk in iter(lambda: fh.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
 class otCMSLocation(object):
     """Location (continent, country, etc) CMS"""
-    uri = None
-    name = None
-    count = 0
+    __slots__ = ["uri", "name", "count"]
 
     def __init__(self):
         super(otCMSLocation, self).__init__()
+        self.uri = None
+        self.name = None
+        self.count = 0
 
 
 class otCMSEntry(object):
-    """Entry (post, page) in the CMS"""
-    uri = None
-    title = None
-    pubdate = None
-    photos = None
-    abstract = None
-    thumbnail = None
-    year = None
-    continent = None
-    country = None
-    city = None
-    region = None
-    state = None
-    location = None
-    body = None
-    language = None
-    featured = None
+    """Entry (post, page) in the CMS
+
+    Entries only hold catalog data (see ENTRY_FIELDS), bodies are rendered on demand.
+    """
+    __slots__ = [attribute for attribute, key in ENTRY_FIELDS] + ["pubdate_human"]
 
     def __init__(self):
         super(otCMSEntry, self).__init__()
+        for attribute in self.__slots__:
+            setattr(self, attribute, None)
+
+    def __getstate__(self):
+        # compact pickling, for the compiled catalog
+        return tuple([getattr(self, attribute) for attribute in self.__slots__])
+
+    def __setstate__(self, state):
+        for attribute, value in zip(self.__slots__, state):
+            setattr(self, attribute, value)
 
     def parameters():
         return ['uri', 'title', 'language','pubdate', 'pubdate_human', 'photos', 'abstract', 'year', 'continent', 'country', 'city', 'region', 'state', 'location', 'body']
@@ -70,82 +170,47 @@ class otCMSEntry(object):
     def __eq__(self, other):
         return self.uri == other.uri
 
+    def __hash__(self):
+        return hash(self.uri)
+
+    def digest(self):
+        """digest of the catalog data for the entry, ignoring any body"""
+        return makeDigest([getattr(self, attribute) for attribute, key in ENTRY_FIELDS if attribute != "body"])
+
+    def paths(self):
+        """paths of the MarkDown source and of the generated HTML, relative to htdocs"""
+        source = re.sub(r"^/", "", self.uri)
+        if re.search(r".*\.html$", source):
+            dest = source
+            source = re.sub(r"\.html$", ".md", source)
+        elif re.search(r".*/$", source):
+            dest = re.sub(r"$", "index.html", source)
+            source = re.sub(r"$", "index.md", source)
+        else:
+            dest = source+".html"
+            source = source+".md"
+        return source, dest
+
     def fromdict(self, dict_entry):
-        if "URI" in dict_entry:
-            self.uri = dict_entry["URI"]
-        if "Title" in dict_entry:
-            self.title = dict_entry["Title"]
-        if "Thumbnail" in dict_entry:
-            self.thumbnail = dict_entry["Thumbnail"]
-        if "Pubdate" in dict_entry:
-            self.pubdate = dict_entry["Pubdate"]
-            if self.pubdate != None:
-                self.pubdate_human = re.sub(r"T.*", "", self.pubdate)
-        if "Photos" in dict_entry:
-            self.photos = dict_entry["Photos"]
-        if "Abstract" in dict_entry:
-            self.abstract = dict_entry["Abstract"]
-        if "Language" in dict_entry:
-            self.language = dict_entry["Language"]
-        if "Year" in dict_entry:
-            self.year = dict_entry["Year"]
-        if "Continent" in dict_entry:
-            self.continent = dict_entry["Continent"]
-        if "Country" in dict_entry:
-            self.country = dict_entry["Country"]
-        if "City" in dict_entry:
-            self.city = dict_entry["City"]
-        if "Region" in dict_entry:
-            self.region = dict_entry["Region"]
-        if "State" in dict_entry:
-            self.state = dict_entry["State"]
-        if "Location" in dict_entry:
-            self.location = dict_entry["Location"]
-        if "Body" in dict_entry:
-            self.body = dict_entry["Body"].decode("utf-8")
-        if "Featured" in dict_entry:
-            self.featured = dict_entry["Featured"]
+        for attribute, key in ENTRY_FIELDS:
+            if key in dict_entry:
+                setattr(self, attribute, dict_entry[key])
+        if self.pubdate != None:
+            self.pubdate_human = re.sub(r"T.*", "", self.pubdate)
+        if isinstance(self.body, bytes):
+            self.body = self.body.decode("utf-8")
 
     def todict(self):
         dict_entry = dict()
-        if self.uri != None:
-            dict_entry["URI"] = self.uri
-        if self.title != None:
-            dict_entry["Title"] = self.title
-        if self.thumbnail != None:
-            dict_entry["Thumbnail"] = self.thumbnail
-        if self.pubdate != None:
-            dict_entry["Pubdate"] = self.pubdate
-        if self.photos != None:
-            dict_entry["Photos"] = self.photos
-        if self.abstract != None:
-            dict_entry["Abstract"] = self.abstract
-        if self.year != None:
-            dict_entry["Year"] = self.year
-        if self.continent != None:
-            dict_entry["Continent"] = self.continent
-        if self.country != None:
-            dict_entry["Country"] = self.country
-        if self.city != None:
-            dict_entry["City"] = self.city
-        if self.region != None:
-            dict_entry["Region"] = self.region
-        if self.state != None:
-            dict_entry["State"] = self.state
-        if self.location != None:
-            dict_entry["Location"] = self.location
-        if self.body != None:
-            dict_entry["Body"] = self.body
-        if self.language != None:
-            dict_entry["Language"] = self.language
-        if self.featured != None:
-            dict_entry["Featured"] = self.featured
-
+        for attribute, key in ENTRY_FIELDS:
+            value = getattr(self, attribute)
+            if value != None:
+                dict_entry[key] = value
         return dict_entry
 
 
     def __repr__(self):
-        return "%s(%r)" % (self.__class__, self.__dict__)
+        return "%s(%r)" % (self.__class__, self.todict())
 
     def __unicode__(self):
         # return u"%r" % self.__dict__
@@ -158,7 +223,35 @@ class otCMSCatalog(list):
     def __init__(self):
         super(otCMSCatalog, self).__init__()
 
-    def fromfile(self, catalog_path):
+    def fromfile(self, catalog_path, use_cache=True):
+        """Load entries from a catalog file
+
+        The parsed entries are kept in a compiled (pickled) copy in the cache directory,
+        which is used instead of parsing the catalog as long as it has the same mtime
+        and size, or failing that the same content.
+        """
+        cache_path = join(siteCacheDir(dirname(catalog_path)), os.path.basename(catalog_path)+".pickle")
+        st = os.stat(catalog_path)
+        digest = None
+        if use_cache:
+            try:
+                with open(cache_path, "rb") as cache_fh:
+                    header = pickle.load(cache_fh)
+                    if header["version"] == CATALOG_CACHE_VERSION:
+                        if header["mtime"] != st.st_mtime_ns or header["size"] != st.st_size:
+                            digest = fileDigest(catalog_path)
+                        if digest == None or digest == header["digest"]:
+                            self.extend(pickle.load(cache_fh))
+                            if digest == None:
+                                return
+                            # same content with a new mtime, refresh the cache header
+                            self.tocache(cache_path, st, digest)
+                            return
+            except Exception:
+                # missing, stale or unreadable cache: parse the catalog
+                del self[:]
+
+        import ast
         entries=list()
         with open(catalog_path,"r") as catalog_fh:
             s = catalog_fh.read()
@@ -167,7 +260,1021 @@ class otCMSCatalog(list):
             cms_entry = otCMSEntry()
             cms_entry.fromdict(entry)
             self.append(cms_entry)
+        if use_cache:
+            self.tocache(cache_path, st, digest or fileDigest(catalog_path))
+
+    def tocache(self, cache_path, st, digest):
+        """Write the compiled copy of a catalog, for fromfile"""
+        header = {"version": CATALOG_CACHE_VERSION, "mtime": st.st_mtime_ns, "size": st.st_size, "digest": digest}
+        try:
+            if not exists(dirname(cache_path)):
+                os.makedirs(dirname(cache_path))
+            with open("%s.%d.tmp" % (cache_path, os.getpid()), "wb") as cache_fh:
+                pickle.dump(header, cache_fh, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(list(self), cache_fh, pickle.HIGHEST_PROTOCOL)
+            os.rename("%s.%d.tmp" % (cache_path, os.getpid()), cache_path)
+        except (IOError, OSError):
+            pass # the cache is an optimisation, the catalog can always be parsed again
+
+
+class otCMSIndex(object):
+    """Date, language and location indexes of a catalog, and neighbours of each entry
+
+    years               all years with entries, in catalog order
+    yearly_selection    entries, per year
+    yearly_lang_selection entries, per language then per year
+    locations           all location names, alphabetically sorted
+    location_types      type (Continent, Country, etc) of each location name
+    loc_selection       entries, per location name
+    neighbours          (previous, next) dated entries, per position in the catalog
+    nearby              candidate nearby entries, per position in the catalog
+    search_terms        score of each search term, per position in the catalog (with search)
+    """
+    def __init__(self, catalog, search=False):
+        super(otCMSIndex, self).__init__()
+        self.years = list()
+        self.yearly_selection = dict()
+        self.yearly_lang_selection = {'en': dict(), 'fr': dict()}
+        self.locations = list()
+        self.location_types = dict()
+        self.loc_selection = dict()
+        self.neighbours = list()
+        self.nearby = list()
+        self.search_terms = list()
+
+        last = len(catalog)-1
+        for i, entry in enumerate(catalog):
+            # ignoring non-dated entry pages
+            previous = catalog[i-1] if i > 0 and catalog[i-1].year != None else None
+            next = catalog[i+1] if i < last and catalog[i+1].year != None else None
+            self.neighbours.append((previous, next))
+            if search:
+                self.search_terms.append(searchEntryTerms(entry))
+
+            if entry.year != None:
+                if entry.year not in self.yearly_selection:
+                    self.years.append(entry.year)
+                    self.yearly_selection[entry.year] = list()
+                    self.yearly_lang_selection['en'][entry.year] = list()
+                    self.yearly_lang_selection['fr'][entry.year] = list()
+                self.yearly_selection[entry.year].append(entry)
+                self.yearly_lang_selection.setdefault(entry.language, dict()).setdefault(entry.year, list()).append(entry)
+
+            # each entry may have (or not have) values for every level of location
+            # and each of these may either be a string or a list
+            for attribute, loctype in LOCATION_LEVELS:
+                for loc_name in locationNames(getattr(entry, attribute)):
+                    if loc_name not in self.loc_selection:
+                        self.location_types[loc_name] = loctype
+                        self.loc_selection[loc_name] = list()
+                    self.loc_selection[loc_name].append(entry)
+        self.locations = sorted(self.loc_selection)
+
+        # entries in the same places share their nearby candidates
+        nearby_by_location = dict()
+        for entry in catalog:
+            places = tuple(tuple(locationNames(getattr(entry, attribute))) for attribute in NEARBY_LEVELS)
+            if places not in nearby_by_location:
+                nearby_by_location[places] = self.nearbyCandidates(places)
+            self.nearby.append([nearby_entry for nearby_entry in nearby_by_location[places] if nearby_entry.uri != entry.uri])
+
+    def nearbyCandidates(self, places):
+        """entries in the given places, from the closest level of location to the broadest
+
+        Broader levels are only searched while there are not enough entries to choose from.
+        Every entry is in its own places, hence the extra one in the count.
+        """
+        candidates = list()
+        seen = set()
+        for level, loc_names in enumerate(places):
+            if level > 0 and len(candidates) > NEARBY_SIZE:
+                break
+            for loc_name in loc_names:
+                for entry in self.loc_selection.get(loc_name, []):
+                    if entry not in seen:
+                        seen.add(entry)
+                        candidates.append(entry)
+        return candidates
+
+
+def locationNames(value):
+    """list of location names for a catalog value, which may be None, a string or a list"""
+    if value == None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+search_tag_re = re.compile(r"<[^>]*>")
+search_accent_re = re.compile("[\u0300-\u036f]")
+search_word_re = re.compile(r"\w+")
+search_shard_re = re.compile(r"^[a-z0-9]+$")
+
+
+def searchTerms(text):
+    """words of a text (or HTML) as they are searched: in lower case and without accents"""
+    import html
+    import unicodedata
+    text = html.unescape(search_tag_re.sub(" ", text))
+    text = search_accent_re.sub("", unicodedata.normalize("NFKD", text.lower()))
+    return [word for word in search_word_re.findall(text) if len(word) > 1 or not word.isascii()]
+
+
+def searchEntryTerms(entry):
+    """score of each search term of an entry, from its title, locations and abstract"""
+    locations = [loc_name for attribute, loctype in LOCATION_LEVELS for loc_name in locationNames(getattr(entry, attribute))]
+    scores = dict()
+    for field, text in [("title", entry.title or ""), ("location", " ".join(locations)), ("abstract", entry.abstract or "")]:
+        for term in set(searchTerms(text)):
+            scores[term] = scores.get(term, 0) + SEARCH_WEIGHTS[field]
+    return scores
+
+
+def searchShard(term):
+    """name of the shard of the search index holding a term: its first characters, or _"""
+    prefix = term[:SEARCH_SHARD_PREFIX]
+    return prefix if search_shard_re.match(prefix) else "_"
+
+
+class otCMSSearchIndex(object):
+    """Inverted index of entries, in JSON files for client-side search
+
+    search/index.json       version, fields of docs, number of docs, docs per file and shards
+    search/docs/N.json      docs N*chunk to (N+1)*chunk-1, as lists of SEARCH_DOC_FIELDS
+    search/terms/SHARD.json doc and score pairs, flattened, per term. The shard of a term
+                            is named after its first two characters, if they are [a-z0-9]
+                            (see searchShard), otherwise it is _
+
+    A search only loads index.json, the shards of its terms and the docs of its results.
+    """
+    def __init__(self):
+        super(otCMSSearchIndex, self).__init__()
+        self.docs = list()
+        self.postings = dict()
+
+    def add(self, entry, scores, body_terms=()):
+        """index an entry, with the scores of its catalog terms (see searchEntryTerms) and terms of its body"""
+        doc = len(self.docs)
+        self.docs.append([getattr(entry, field) for field in SEARCH_DOC_FIELDS])
+        if body_terms:
+            scores = dict(scores)
+            for term in body_terms:
+                scores[term] = scores.get(term, 0) + SEARCH_WEIGHTS["body"]
+        for term, score in scores.items():
+            self.postings.setdefault(term, list()).extend((doc, score))
+
+    def files(self):
+        """(path relative to htdocs, JSON text) of every file of the index"""
+        shards = dict()
+        for term, postings in self.postings.items():
+            shards.setdefault(searchShard(term), dict())[term] = postings
+        def dumps(value):
+            return json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        files = [(join(SEARCH_DIR, "index.json"), dumps({"version": SEARCH_INDEX_VERSION, "fields": SEARCH_DOC_FIELDS,
+                                                          "docs": len(self.docs), "chunk": SEARCH_DOCS_CHUNK,
+                                                          "shards": sorted(shards)}))]
+        for chunk in range(0, len(self.docs), SEARCH_DOCS_CHUNK):
+            files.append((join(SEARCH_DIR, "docs", "%d.json" % (chunk // SEARCH_DOCS_CHUNK)), dumps(self.docs[chunk:chunk+SEARCH_DOCS_CHUNK])))
+        for shard in sorted(shards):
+            files.append((join(SEARCH_DIR, "terms", shard+".json"), dumps(shards[shard])))
+        return files
+
+
+class otCMSSnippets(object):
+    """Memoized rendering of lists of entries, one entry at a time
+
+    The list template renders a selection of entries. Rendered for a single entry,
+    it gives the fragment for that entry; a whole selection is then the
+    concatenation of fragments, each rendered once per run.
+    """
+    def __init__(self, template):
+        super(otCMSSnippets, self).__init__()
+        self.template = template
+        self.head = template.render_unicode(selection = [])
+        self.fragments = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def fragment(self, entry):
+        """html for a single entry, rendered if its catalog data was not seen before"""
+        key = (entry.uri, entry.digest())
+        if key in self.fragments:
+            self.hits = self.hits + 1
+            return self.fragments[key]
+        fragment = self.template.render_unicode(selection = [entry])[len(self.head):]
+        self.fragments[key] = fragment
+        self.misses = self.misses + 1
+        return fragment
+
+    def render(self, selection):
+        """html for a selection of entries, same as rendering the template for it"""
+        return self.head + "".join([self.fragment(entry) for entry in selection])
+
+
+class otCMSManifest(object):
+    """Record of the inputs each generated file was built from, kept between runs
+
+    Sources are tracked by mtime and size, and only re-hashed when those change.
+    Outputs are tracked by the key of their inputs and the digest of their content.
+    All paths are relative to the root (htdocs) directory.
+    """
+    def __init__(self, manifest_path, root):
+        super(otCMSManifest, self).__init__()
+        self.path = manifest_path
+        self.root = root
+        self.sources = dict()
+        self.outputs = dict()
+        self.templates = dict()
+        self.rebuilt = 0
+
+    def load(self):
+        try:
+            with open(self.path, "r") as manifest_fh:
+                manifest = json.load(manifest_fh)
+        except (IOError, OSError, ValueError):
+            return
+        if manifest.get("version") != MANIFEST_VERSION:
+            return
+        self.sources = manifest.get("sources", dict())
+        self.outputs = manifest.get("outputs", dict())
+        self.templates = manifest.get("templates", dict())
+
+    def save(self):
+        manifest = {"version": MANIFEST_VERSION, "templates": self.templates,
+                    "sources": self.sources, "outputs": self.outputs}
+        if not exists(dirname(self.path)):
+            os.makedirs(dirname(self.path))
+        with open(self.path+".tmp", "w") as manifest_fh:
+            json.dump(manifest, manifest_fh, sort_keys=True)
+        os.rename(self.path+".tmp", self.path)
+
+    def source_digest(self, source):
+        """digest of a source file, or None if it does not exist"""
+        try:
+            st = os.stat(join(self.root, source))
+        except OSError:
+            self.sources.pop(source, None)
+            return None
+        known = self.sources.get(source)
+        if known and known[0] == st.st_mtime_ns and known[1] == st.st_size:
+            return known[2]
+        digest = fileDigest(join(self.root, source))
+        self.sources[source] = [st.st_mtime_ns, st.st_size, digest]
+        return digest
+
+    def templates_digest(self, templates_dir):
+        """digest of every template, any change to one of them invalidates all outputs"""
+        self.templates = dict()
+        for fname in sorted(os.listdir(templates_dir)):
+            if os.path.isfile(join(templates_dir, fname)):
+                self.templates[fname] = fileDigest(join(templates_dir, fname))
+        return makeDigest(sorted(self.templates.items()))
+
+    def is_fresh(self, output, key):
+        """True if output exists, is untouched, and was built from the inputs described by key"""
+        known = self.outputs.get(output)
+        if not known or known["key"] != key:
+            return False
+        try:
+            st = os.stat(join(self.root, output))
+        except OSError:
+            return False
+        if st.st_size != known["size"]:
+            return False
+        if st.st_mtime_ns != known["mtime"] and fileDigest(join(self.root, output)) != known["digest"]:
+            return False
+        return True
+
+    def record(self, output, key, digest=None):
+        """remember the inputs and content of a freshly generated output"""
+        st = os.stat(join(self.root, output))
+        if digest == None:
+            digest = fileDigest(join(self.root, output))
+        self.outputs[output] = {"key": key, "digest": digest,
+                                "mtime": st.st_mtime_ns, "size": st.st_size}
+        self.rebuilt = self.rebuilt + 1
+
+    def remove(self, output):
+        """forget an output which is no longer generated, and remove it with its compressed siblings"""
+        self.outputs.pop(output, None)
+        for fname in [output] + [output+extension for extension in COMPRESSED_EXTENSIONS]:
+            if exists(join(self.root, fname)):
+                os.remove(join(self.root, fname))
+        # and the directories made for it, once empty (e.g. search/terms)
+        directory = dirname(output)
+        while directory and os.path.isdir(join(self.root, directory)) and not os.listdir(join(self.root, directory)):
+            os.rmdir(join(self.root, directory))
+            directory = dirname(directory)
+
+
+class otCMSRenderCache(object):
+    """On-disk cache of the HTML rendered from MarkDown sources
+
+    Rendered bodies are stored under the digest of their source, the markdown2
+    version and extras, so an unchanged source is never rendered twice.
+    The cache is kept under max_size bytes by evicting the least recently used bodies.
+    """
+    def __init__(self, cache_dir, max_size=128*1024*1024):
+        super(otCMSRenderCache, self).__init__()
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, source_fn, source_digest=None):
+        """HTML for the MarkDown in source_fn, from the cache if possible"""
+        import markdown2
+        if source_digest == None:
+            source_digest = fileDigest(source_fn)
+        cache_fn = join(self.cache_dir, makeDigest(source_digest, markdown2.__version__, MARKDOWN_EXTRAS)+".html")
+        try:
+            with open(cache_fn, "r", encoding="utf-8") as cache_fh:
+                html = cache_fh.read()
+            os.utime(cache_fn, None) # last use, for eviction
+            self.hits = self.hits + 1
+            return html
+        except (IOError, OSError):
+            pass
+        html = markdown2.markdown_path(source_fn, extras=MARKDOWN_EXTRAS)
+        html = html.replace("<p></div></p>", "</div>") # workaround for annoying markdown behavior
+        if not exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        with open("%s.%d.tmp" % (cache_fn, os.getpid()), "w", encoding="utf-8") as cache_fh:
+            cache_fh.write(html)
+        os.rename("%s.%d.tmp" % (cache_fn, os.getpid()), cache_fn)
+        self.misses = self.misses + 1
+        return html
+
+    def prune(self):
+        """evict least recently used bodies until the cache fits in max_size"""
+        pruneCache(self.cache_dir, self.max_size)
+
+
+def pruneCache(cache_dir, max_size):
+    """remove the least recently used (touched) files of a cache directory until it fits in max_size bytes"""
+    if not exists(cache_dir):
+        return
+    cached = list()
+    for fname in os.listdir(cache_dir):
+        st = os.stat(join(cache_dir, fname))
+        cached.append((st.st_mtime, st.st_size, fname))
+    total = sum(size for mtime, size, fname in cached)
+    for mtime, size, fname in sorted(cached):
+        if total <= max_size:
+            break
+        os.remove(join(cache_dir, fname))
+        total = total - size
+
+
+class otCMSItemCache(object):
+    """On-disk cache of items made during a build, in JSON: e.g. the <entry> elements
+    of Atom feeds, or the words of entry bodies for the search index
+
+    Items are stored under a digest of everything they are made from, one file
+    per item, so that a build only reads the items it needs, and makes each
+    of them at most once. Like otCMSRenderCache, the cache is kept under max_size
+    bytes by evicting the least recently used items.
+    """
+    def __init__(self, cache_dir, max_size=64*1024*1024):
+        super(otCMSItemCache, self).__init__()
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def item(self, key, make):
+        """the item cached under key, or the one returned by make(), which is then cached"""
+        cache_fn = join(self.cache_dir, makeDigest(ITEM_CACHE_VERSION, key)+".json")
+        try:
+            with open(cache_fn, "r", encoding="utf-8") as cache_fh:
+                item = json.load(cache_fh)
+            os.utime(cache_fn, None) # last use, for eviction
+            self.hits = self.hits + 1
+            return item
+        except (IOError, OSError, ValueError):
+            pass
+        item = make()
+        if not exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        with open("%s.%d.tmp" % (cache_fn, os.getpid()), "w", encoding="utf-8") as cache_fh:
+            json.dump(item, cache_fh)
+        os.rename("%s.%d.tmp" % (cache_fn, os.getpid()), cache_fn)
+        self.misses = self.misses + 1
+        return item
+
+    def prune(self):
+        """evict least recently used items until the cache fits in max_size"""
+        pruneCache(self.cache_dir, self.max_size)
+
+
+def makeThumbnails(image_fn, force=False):
+    """Make the square thumbnails of an image, in the tn directory next to it
+
+    Same result as ImageMagick's -thumbnail WxH^ -gravity center -extent WxH:
+    scaled to cover the square, then center-cropped. The image is decoded once,
+    at the smallest scale JPEG allows for the biggest thumbnail, and smaller
+    thumbnails are made from the bigger ones.
+    Returns False if all thumbnails were newer than the image.
+    """
+    from PIL import Image, ImageOps
+    directory, fname = os.path.split(image_fn)
+    thumbnails = [(join(directory, "tn", prefix+fname+".jpg"), size) for prefix, size in THUMBNAIL_SIZES]
+    if not force:
+        image_mtime = os.stat(image_fn).st_mtime
+        try:
+            if min(os.stat(thumbnail_fn).st_mtime for thumbnail_fn, size in thumbnails) >= image_mtime:
+                return False
+        except OSError:
+            pass
+    if not exists(join(directory, "tn")):
+        os.makedirs(join(directory, "tn"), exist_ok=True)
+    im = Image.open(image_fn)
+    biggest = max(size for thumbnail_fn, size in thumbnails)
+    im.draft("RGB", (biggest, biggest))
+    im = im.convert("RGB")
+    for thumbnail_fn, size in sorted(thumbnails, key=lambda thumbnail: -thumbnail[1]):
+        im = ImageOps.fit(im, (size, size), Image.LANCZOS, centering=(0.5, 0.5))
+        im.save("%s.%d.tmp" % (thumbnail_fn, os.getpid()), "JPEG", quality=92)
+        os.rename("%s.%d.tmp" % (thumbnail_fn, os.getpid()), thumbnail_fn)
+    return True
+
+
+def probeJPEG(fname):
+    """Read the dimensions and EXIF orientation of a JPEG from its headers only
+
+    Returns a dict with width, height (as displayed, i.e. swapped for rotated
+    images), orientation and, if known, datetime_original, or None if fname is
+    not a JPEG we can read, e.g. with truncated headers.
+    """
+    try:
+        return readJPEG(fname)
+    except struct.error:
+        return None # truncated headers
+
+
+def readJPEG(fname):
+    """probeJPEG, raising struct.error on truncated headers"""
+    info = {"orientation": 1}
+    with open(fname, "rb") as jpeg_fh:
+        if jpeg_fh.read(2) != b"\xff\xd8":
+            return None
+        while True:
+            byte = jpeg_fh.read(1)
+            while byte == b"\xff": # fill bytes
+                byte = jpeg_fh.read(1)
+            if not byte:
+                return None
+            marker = ord(byte)
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                continue # no payload
+            length = struct.unpack(">H", jpeg_fh.read(2))[0]
+            if marker == 0xE1:
+                segment = jpeg_fh.read(length-2)
+                if segment[:6] == b"Exif\x00\x00":
+                    info.update(readEXIF(segment[6:]))
+            elif marker in JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">xHH", jpeg_fh.read(5))
+                if info["orientation"] in (5, 6, 7, 8):
+                    width, height = height, width
+                info["width"], info["height"] = width, height
+                return info
+            elif marker == 0xD9 or marker == 0xDA: # end of image, or start of scan without a frame
+                return None
+            else:
+                jpeg_fh.seek(length-2, os.SEEK_CUR)
+
+
+def readEXIF(tiff):
+    """orientation and original date (DateTimeOriginal) from the TIFF structure of an EXIF segment"""
+    info = dict()
+    byte_order = "<" if tiff[:2] == b"II" else ">"
+    try:
+        ifd_offset = struct.unpack(byte_order+"I", tiff[4:8])[0]
+        for tag, value in readIFD(tiff, ifd_offset, byte_order):
+            if tag == 0x0112:
+                info["orientation"] = value
+            elif tag == 0x8769: # Exif sub-IFD, where the camera records when the photo was taken
+                for exif_tag, exif_value in readIFD(tiff, value, byte_order):
+                    if exif_tag == 0x9003:
+                        # "YYYY:MM:DD HH:MM:SS\0", always stored at an offset
+                        info["datetime_original"] = tiff[exif_value:exif_value+19].decode("ascii")
+    except (struct.error, UnicodeDecodeError):
+        pass # truncated or broken EXIF
+    return info
+
+
+def readIFD(tiff, offset, byte_order):
+    """tags and (short or long) values of a TIFF image file directory"""
+    count = struct.unpack(byte_order+"H", tiff[offset:offset+2])[0]
+    for i in range(count):
+        entry = tiff[offset+2+12*i:offset+14+12*i]
+        tag, value_type = struct.unpack(byte_order+"HH", entry[:4])
+        if value_type == 3: # SHORT
+            value = struct.unpack(byte_order+"H", entry[8:10])[0]
+        else:
+            value = struct.unpack(byte_order+"I", entry[8:12])[0]
+        yield tag, value
+
+
+def imageSize(fname):
+    """(width, height) of an image as displayed, from its headers if it is a JPEG"""
+    info = probeJPEG(fname)
+    if info == None:
+        from PIL import Image
+        im = Image.open(fname)
+        if im.getexif().get(0x0112) in (5, 6, 7, 8):
+            return im.size[1], im.size[0]
+        return im.size
+    return info["width"], info["height"]
+
+
+def rdfName(fname):
+    """name of the PhotoRDF file of an image: photo.v2.jpg -> photo.v2.rdf"""
+    return re.sub(r"\.[^./]*$", "", fname)+".rdf"
+
+
+def readPhotoRDF(fname):
+    """title, description, coverage and date of a PhotoRDF file, '' when missing
+
+    Elements are matched on their local name, whatever their namespace prefix.
+    Files which are not well-formed XML (e.g. written by hand, with a bare &)
+    are read with a more forgiving pattern.
+    """
+    from xml.etree import ElementTree
+    photo = dict((field, '') for field in PHOTO_RDF_FIELDS)
+    try:
+        for event, elem in ElementTree.iterparse(fname):
+            field = elem.tag.rsplit("}", 1)[-1]
+            if field in photo and not photo[field]:
+                photo[field] = "".join(elem.itertext()).strip()
+    except ElementTree.ParseError:
+        import html
+        with open(fname, "r") as rdf_fh:
+            rdf = rdf_fh.read()
+        for field in PHOTO_RDF_FIELDS:
+            match = re.search(r'<(?:\w+:)?%s>(.*?)</(?:\w+:)?%s>' % (field, field), rdf, re.DOTALL)
+            if match:
+                photo[field] = html.unescape(match.group(1)).strip()
+    return photo
+
+
+class otCMSPhotoRDFs(object):
+    """PhotoRDF metadata of the images of a directory, cached for the directory (see directoryCachePath)
+
+    Each .rdf file is only parsed again when its mtime or size changes.
+    """
+    def __init__(self, directory):
+        super(otCMSPhotoRDFs, self).__init__()
+        self.directory = directory
+        self.path = directoryCachePath(directory, "rdf.json")
+        self.photos = dict()
+        self.changed = False
+        try:
+            with open(self.path, "r") as rdf_fh:
+                cached = json.load(rdf_fh)
+            if cached.get("version") == PHOTO_RDF_VERSION:
+                self.photos = cached["photos"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def read(self, fnames=None):
+        """metadata of all the .rdf files of the directory (or of fnames), by file name"""
+        if fnames == None:
+            fnames = os.listdir(self.directory)
+        photos = dict()
+        cached = dict()
+        for fname in fnames:
+            if not fname.endswith(".rdf"):
+                continue
+            st = os.stat(join(self.directory, fname))
+            known = self.photos.get(fname)
+            if not (known and known[0] == st.st_mtime_ns and known[1] == st.st_size):
+                known = [st.st_mtime_ns, st.st_size, readPhotoRDF(join(self.directory, fname))]
+                self.changed = True
+            cached[fname] = known
+            photos[fname] = known[2]
+        if len(cached) != len(self.photos):
+            self.changed = True # some .rdf files were removed
+        self.photos = cached
+        return photos
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            if not exists(dirname(self.path)):
+                os.makedirs(dirname(self.path))
+            with open(self.path+".tmp", "w") as rdf_fh:
+                json.dump({"version": PHOTO_RDF_VERSION, "photos": self.photos}, rdf_fh, sort_keys=True)
+            os.rename(self.path+".tmp", self.path)
+        except (IOError, OSError):
+            pass # e.g. read-only directory, the files will be parsed again next time
+        self.changed = False
+
+
+class otCMSImageSizes(object):
+    """Displayed dimensions of the images of a directory, cached for the directory (see directoryCachePath)
+
+    Dimensions are read from JPEG headers (see probeJPEG), or with PIL for other
+    images, and only read again when the mtime or size of an image changes.
+    """
+    def __init__(self, directory):
+        super(otCMSImageSizes, self).__init__()
+        self.directory = directory
+        self.path = directoryCachePath(directory, "sizes.json")
+        self.sizes = dict()
+        self.changed = False
+        try:
+            with open(self.path, "r") as sizes_fh:
+                cached = json.load(sizes_fh)
+            if cached.get("version") == IMAGE_SIZES_VERSION:
+                self.sizes = cached["sizes"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def size(self, fname):
+        """(width, height) of an image, as displayed"""
+        st = os.stat(join(self.directory, fname))
+        known = self.sizes.get(fname)
+        if known and known[0] == st.st_mtime_ns and known[1] == st.st_size:
+            return known[2], known[3]
+        width, height = imageSize(join(self.directory, fname))
+        self.sizes[fname] = [st.st_mtime_ns, st.st_size, width, height]
+        self.changed = True
+        return width, height
+
+    def probe(self, fnames, jobs=8):
+        """read the sizes of many images at once, in threads: the reads are tiny but may be slow (e.g. network mounts)"""
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(self.size, fnames))
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            if not exists(dirname(self.path)):
+                os.makedirs(dirname(self.path))
+            with open(self.path+".tmp", "w") as sizes_fh:
+                json.dump({"version": IMAGE_SIZES_VERSION, "sizes": self.sizes}, sizes_fh, sort_keys=True)
+            os.rename(self.path+".tmp", self.path)
+        except (IOError, OSError):
+            pass # e.g. read-only directory, the sizes will be read again next time
+        self.changed = False
+
+
+class otCMSMediaIndex(object):
+    """Dimensions, thumbnails and PhotoRDF metadata of every image under a root (htdocs)
+
+    Images are keyed by their path relative to the root. update() walks the root,
+    and only probes images and reads .rdf files whose mtime or size changed.
+    """
+    def __init__(self, root, path=None):
+        super(otCMSMediaIndex, self).__init__()
+        self.root = root
+        self.path = path or join(siteCacheDir(root), "media.json")
+        self.images = dict()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as index_fh:
+                index = json.load(index_fh)
+            if index.get("version") == MEDIA_INDEX_VERSION:
+                self.images = index["images"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return self
+
+    def save(self):
+        if not exists(dirname(self.path)):
+            os.makedirs(dirname(self.path))
+        with open(self.path+".tmp", "w") as index_fh:
+            json.dump({"version": MEDIA_INDEX_VERSION, "images": self.images}, index_fh, sort_keys=True)
+        os.rename(self.path+".tmp", self.path)
+
+    def update(self):
+        """bring the index up to date with the files under root. Returns the number of images (re)indexed"""
+        indexed = 0
+        seen = set()
+        for directory, subdirs, fnames in os.walk(self.root):
+            # thumbnails are recorded with their image, caches are not content
+            subdirs[:] = sorted(subdir for subdir in subdirs if subdir not in ("tn", CACHE_DIR))
+            fnames = set(fnames)
+            for fname in sorted(fnames):
+                if not fname.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                image = os.path.relpath(join(directory, fname), self.root)
+                seen.add(image)
+                if self.updateImage(image, directory, fname, fnames):
+                    indexed = indexed + 1
+        for image in set(self.images) - seen:
+            del self.images[image]
+        return indexed
+
+    def updateImage(self, image, directory, fname, fnames):
+        st = os.stat(join(directory, fname))
+        record = self.images.get(image)
+        changed = False
+        if not record or record["mtime"] != st.st_mtime_ns or record["size"] != st.st_size:
+            width, height = imageSize(join(directory, fname))
+            record = {"mtime": st.st_mtime_ns, "size": st.st_size, "width": width, "height": height, "rdf_mtime": None}
+            record.update((field, '') for field in PHOTO_RDF_FIELDS)
+            changed = True
+        rdf_fname = rdfName(fname)
+        rdf_mtime = os.stat(join(directory, rdf_fname)).st_mtime_ns if rdf_fname in fnames else None
+        if rdf_mtime != record["rdf_mtime"]:
+            record.update(readPhotoRDF(join(directory, rdf_fname)) if rdf_mtime else
+                          dict((field, '') for field in PHOTO_RDF_FIELDS))
+            record["rdf_mtime"] = rdf_mtime
+            changed = True
+        record["thumbnails"] = dict()
+        for prefix, size in THUMBNAIL_SIZES:
+            thumbnail = join("tn", prefix+fname+".jpg")
+            if exists(join(directory, thumbnail)):
+                record["thumbnails"][prefix] = thumbnail
+        self.images[image] = record
+        return changed
+
+    def directory(self, rel_dir):
+        """records of the images of a directory, relative to root, by file name"""
+        rel_dir = os.path.normpath(rel_dir)
+        return dict((os.path.basename(image), record) for image, record in self.images.items()
+                    if dirname(image) == ("" if rel_dir == "." else rel_dir))
+
+    def size(self, image):
+        """(width, height) of an image or one of its thumbnails, relative to root, or None"""
+        image = os.path.normpath(image)
+        if image in self.images:
+            return self.images[image]["width"], self.images[image]["height"]
+        directory, fname = os.path.split(image)
+        for prefix, size in THUMBNAIL_SIZES:
+            if os.path.basename(directory) == "tn" and fname.startswith(prefix):
+                # tn/lg_photo.jpg.jpg, but some pages link to tn/lg_photo.jpg
+                for original in (fname[len(prefix):-len(".jpg")], fname[len(prefix):]):
+                    if join(dirname(directory), original) in self.images:
+                        return size, size
+        return None
+
+
+def findMediaIndex(directory):
+    """media index of the site a directory belongs to, looking up from it
+
+    Returns the loaded index and the path of directory relative to its root,
+    or None, None if there is no index.
+    """
+    root = realpath(directory)
+    while True:
+        if exists(join(siteCacheDir(root), "media.json")):
+            return otCMSMediaIndex(root).load(), os.path.relpath(realpath(directory), root)
+        if root == dirname(root):
+            return None, None
+        root = dirname(root)
+
+
+class otCMSWriter(object):
+    """Writes generated files under a root directory
+
+    Files are written atomically (through a temporary file, then renamed), and only
+    if their content changed, so unchanged files keep their mtime. The compressed
+    siblings of a rewritten file (see otCMSCompressor) are removed, rather than
+    served out of date, until the file is compressed again.
+    """
+    def __init__(self, root):
+        super(otCMSWriter, self).__init__()
+        self.root = root
+        self.written = 0
+        self.unchanged = 0
+        self.bytes_written = 0
+        self.seconds = 0.0
+
+    def write(self, output, text):
+        """write text (utf-8 encoded) to output, relative to the root. Returns the digest of the content"""
+        started = time.perf_counter()
+        data = text.encode("utf-8")
+        digest = hashlib.sha1(data).hexdigest()
+        output_fn = join(self.root, output)
+        try:
+            if os.stat(output_fn).st_size == len(data) and fileDigest(output_fn) == digest:
+                self.unchanged = self.unchanged + 1
+                self.seconds = self.seconds + time.perf_counter() - started
+                return digest
+        except OSError:
+            if not exists(dirname(output_fn)):
+                os.makedirs(dirname(output_fn), exist_ok=True)
+        with open("%s.%d.tmp" % (output_fn, os.getpid()), "wb") as output_fh:
+            output_fh.write(data)
+        os.rename("%s.%d.tmp" % (output_fn, os.getpid()), output_fn)
+        for extension in COMPRESSED_EXTENSIONS:
+            if exists(output_fn+extension):
+                os.remove(output_fn+extension)
+        self.written = self.written + 1
+        self.bytes_written = self.bytes_written + len(data)
+        self.seconds = self.seconds + time.perf_counter() - started
+        return digest
+
+    def counters(self):
+        return [self.written, self.unchanged, self.bytes_written, self.seconds]
+
+    def add(self, counters):
+        """add counters from another writer, e.g. in a worker process"""
+        self.written, self.unchanged, self.bytes_written, self.seconds = [a+b for a, b in zip(self.counters(), counters)]
+
+
+def compressFile(job):
+    """write the compressed siblings of a file, e.g. index.html.gz. Returns the number of bytes written"""
+    fname, extensions = job
+    with open(fname, "rb") as source_fh:
+        data = source_fh.read()
+    bytes_written = 0
+    for extension in extensions:
+        if extension == ".br":
+            import brotli
+            compressed = brotli.compress(data, mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+        else:
+            import gzip
+            # no timestamp, so that the same file always compresses to the same bytes
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        with open("%s%s.%d.tmp" % (fname, extension, os.getpid()), "wb") as compressed_fh:
+            compressed_fh.write(compressed)
+        os.rename("%s%s.%d.tmp" % (fname, extension, os.getpid()), fname+extension)
+        bytes_written = bytes_written + len(compressed)
+    return bytes_written
+
+
+class otCMSCompressor(object):
+    """Pre-compressed siblings of generated files: .gz, and .br if brotli is installed
+
+    For web servers which serve them as they are (e.g. nginx gzip_static).
+    Files are only compressed again if their content changed since the last time
+    (their digest, as recorded in the manifest), or if a sibling is missing.
+    """
+    def __init__(self, root, path):
+        super(otCMSCompressor, self).__init__()
+        self.root = root
+        self.path = path
+        self.extensions = [".gz"]
+        try:
+            import brotli
+            self.extensions.append(".br")
+        except ImportError:
+            pass
+        self.digests = dict()
+        self.compressed = 0
+        self.bytes_written = 0
+
+    def load(self):
+        try:
+            with open(self.path, "r") as compressed_fh:
+                compressed = json.load(compressed_fh)
+            if compressed.get("version") == COMPRESSED_VERSION and compressed.get("extensions") == self.extensions \
+               and compressed.get("brotli_quality") == BROTLI_QUALITY:
+                self.digests = compressed["digests"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return self
+
+    def save(self):
+        if not exists(dirname(self.path)):
+            os.makedirs(dirname(self.path))
+        with open(self.path+".tmp", "w") as compressed_fh:
+            json.dump({"version": COMPRESSED_VERSION, "extensions": self.extensions, "brotli_quality": BROTLI_QUALITY,
+                       "digests": self.digests}, compressed_fh, sort_keys=True)
+        os.rename(self.path+".tmp", self.path)
+
+    def stale(self, outputs):
+        """outputs (a dict of digests, by path) whose compressed siblings are missing or outdated"""
+        stale = list()
+        for output in sorted(outputs):
+            if self.digests.get(output) != outputs[output]:
+                stale.append(output)
+            elif not all(exists(join(self.root, output+extension)) for extension in self.extensions):
+                stale.append(output)
+        return stale
+
+    def compress(self, outputs, jobs=1):
+        """compress the stale outputs, with jobs processes"""
+        stale = [output for output in self.stale(outputs) if exists(join(self.root, output))]
+        compress_jobs = [(join(self.root, output), self.extensions) for output in stale]
+        if jobs > 1 and len(compress_jobs) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(compressFile, compress_jobs, chunksize=8))
+        else:
+            results = [compressFile(job) for job in compress_jobs]
+        # outputs which are no longer generated (see otCMSManifest.remove) are forgotten
+        self.digests = dict((output, digest) for output, digest in self.digests.items() if output in outputs)
+        for output in stale:
+            self.digests[output] = outputs[output]
+        self.compressed = len(stale)
+        self.bytes_written = sum(results)
+
+
+class otCMSTimedTemplate(object):
+    """A template, whose renderings are timed into a dict of [wall, cpu, count], by template name"""
+    def __init__(self, template, name, timings):
+        super(otCMSTimedTemplate, self).__init__()
+        self.template = template
+        self.name = name
+        self.timings = timings
+
+    def render_unicode(self, *args, **kwargs):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            return self.template.render_unicode(*args, **kwargs)
+        finally:
+            addTiming(self.timings, self.name, time.perf_counter()-wall, time.process_time()-cpu)
+
+
+def timedTemplates(templates, timings):
+    """a registry of templates (a dict, by name), with the renderings of each template timed"""
+    return dict((name, otCMSTimedTemplate(template, name, timings)) for name, template in templates.items())
+
+
+def addTiming(timings, name, wall, cpu, count=1):
+    """add wall and CPU time, and a count, to the [wall, cpu, count] of name in timings"""
+    known = timings.setdefault(name, [0.0, 0.0, 0])
+    known[0], known[1], known[2] = known[0]+wall, known[1]+cpu, known[2]+count
+
+
+class otCMSProfile(object):
+    """Wall and CPU time of the stages of a build, and of the templates it renders
+
+    Along with the time of each entry page, and counters such as cache hits
+    or bytes written. A build goes through stages one after the other (see
+    begin and end), and some stages are parts of others, e.g. the MarkDown
+    rendering of the entry pages.
+    """
+    def __init__(self):
+        super(otCMSProfile, self).__init__()
+        self.stages = dict()
+        self.templates = dict()
+        self.entries = list()
+        self.counters = dict()
+        self.current = None
+
+    def begin(self, name):
+        """end the current stage, if any, and start the next one"""
+        self.end()
+        self.stages.setdefault(name, [0.0, 0.0, 0])
+        self.current = (name, time.perf_counter(), time.process_time())
+
+    def end(self):
+        if self.current != None:
+            name, wall, cpu = self.current
+            addTiming(self.stages, name, time.perf_counter()-wall, time.process_time()-cpu)
+            self.current = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """time a block as a stage, e.g. with profile.stage("catalog"): ..."""
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def timed(self, templates):
+        """a registry of templates (a dict, by name), with the renderings of each template timed"""
+        return timedTemplates(templates, self.templates)
+
+    def entry(self, uri, wall, cpu):
+        self.entries.append((wall, cpu, uri))
+
+    def hits(self, name, hits, misses):
+        """record the hits and misses of a cache"""
+        self.counters[name+" hits"] = self.counters.get(name+" hits", 0) + hits
+        self.counters[name+" misses"] = self.counters.get(name+" misses", 0) + misses
+
+    def todict(self, slowest=10):
+        return {"stages": self.stages, "templates": self.templates, "counters": self.counters,
+                "slowest_entries": [{"uri": uri, "wall": wall, "cpu": cpu} for wall, cpu, uri in sorted(self.entries, reverse=True)[:slowest]]}
+
+    def report(self, slowest=10):
+        """the profile, as a table"""
+        lines = ["%-34s %10s %10s %8s" % ("Stage", "Wall (s)", "CPU (s)", "Count")]
+        for name, (wall, cpu, count) in self.stages.items():
+            lines.append("%-34s %10.3f %10.3f %8d" % (name, wall, cpu, count))
+        lines.append("")
+        lines.append("%-34s %10s %10s %8s" % ("Template", "Wall (s)", "CPU (s)", "Renders"))
+        for name, (wall, cpu, count) in sorted(self.templates.items(), key=lambda timing: -timing[1][0]):
+            lines.append("%-34s %10.3f %10.3f %8d" % (name, wall, cpu, count))
+        lines.append("")
+        lines.append("%-34s %10s %10s" % ("Slowest entries", "Wall (s)", "CPU (s)"))
+        for wall, cpu, uri in sorted(self.entries, reverse=True)[:slowest]:
+            lines.append("%-34s %10.3f %10.3f" % (uri, wall, cpu))
+        lines.append("")
+        lines.append("%-34s %10s" % ("Counter", "Value"))
+        for name, value in sorted(self.counters.items()):
+            if name.endswith(" hits"):
+                lookups = value + self.counters.get(name[:-len(" hits")]+" misses", 0)
+                lines.append("%-34s %10d %9.1f%%" % (name, value, 100.0*value/lookups if lookups else 0))
+            else:
+                lines.append("%-34s %10d" % (name, value))
+        return "\n".join(lines)
 
 
 if __name__ == '__main__':
-    unittest.main()
+    # the tests are in test_otCMS.py, so that unittest is not imported by otCMS
+    import unittest
+    unittest.main(module="test_otCMS")
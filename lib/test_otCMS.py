@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_otCMS.py
+
+Tests of otCMS. Run with python -m unittest (or pytest) in lib/, or python otCMS.py
+"""
+
+import sys
+import re
+import json
+import unittest
+from os.path import join, dirname, exists, realpath
+
+from otCMS import SEARCH_DIR, SEARCH_WEIGHTS, STARTUP_BUDGET_US, STARTUP_LAZY_IMPORTS, otCMSCatalog, otCMSEntry, otCMSItemCache, otCMSIndex, otCMSSearchIndex, probeJPEG, rdfName, searchShard, searchTerms, seededSample
+
+
+class otCMSTests(unittest.TestCase):
+    def setUp(self):
+        self.catalog = otCMSCatalog()
+        for dict_entry in [
+                {"URI": "/2013/01-Foo/", "Year": 2013, "Language": "en", "Country": "Spain", "City": "Barcelona"},
+                {"URI": "/contact.html", "Language": "en"},
+                {"URI": "/2012/12-Bar/", "Year": 2012, "Language": "fr", "Country": "Spain", "City": "Madrid"},
+                {"URI": "/2012/11-Baz/", "Year": 2012, "Language": "en", "Country": "UK", "City": ["London", "Manchester"]}]:
+            entry = otCMSEntry()
+            entry.fromdict(dict_entry)
+            self.catalog.append(entry)
+
+    def test_index(self):
+        index = otCMSIndex(self.catalog)
+        self.assertEqual(index.years, [2013, 2012])
+        self.assertEqual([e.uri for e in index.yearly_lang_selection['en'][2012]], ["/2012/11-Baz/"])
+        self.assertEqual(index.locations, ["Barcelona", "London", "Madrid", "Manchester", "Spain", "UK"])
+        self.assertEqual(index.location_types["London"], "City")
+        self.assertEqual(len(index.loc_selection["Spain"]), 2)
+        # non-dated entries are not neighbours
+        self.assertEqual(index.neighbours[0], (None, None))
+        self.assertEqual(index.neighbours[2][1].uri, "/2012/11-Baz/")
+
+    def test_nearby(self):
+        index = otCMSIndex(self.catalog)
+        self.assertEqual(len(set(self.catalog)), 4)
+        self.assertEqual([e.uri for e in index.nearby[0]], ["/2012/12-Bar/"])
+        self.assertEqual(index.nearby[1], [])
+        self.assertEqual(index.nearby[3], [])
+
+    def test_search(self):
+        self.assertEqual(searchTerms("<p>Lorém IPSUM, à Paris &amp; 東京</p>"), ["lorem", "ipsum", "paris", "東京"])
+        index = otCMSIndex(self.catalog, search=True)
+        self.assertEqual(index.search_terms[0]["barcelona"], SEARCH_WEIGHTS["location"])
+        self.assertEqual(index.search_terms[1], {})
+        search_index = otCMSSearchIndex()
+        for entry, scores in zip(self.catalog, index.search_terms):
+            search_index.add(entry, scores, ["barcelona"])
+        files = dict(search_index.files())
+        self.assertEqual(json.loads(files[join(SEARCH_DIR, "index.json")])["docs"], len(self.catalog))
+        self.assertEqual(json.loads(files[join(SEARCH_DIR, "terms", "ba.json")])["barcelona"][:4], [0, 4, 1, 1])
+        self.assertEqual(searchShard("東京"), "_")
+
+    def test_item_cache(self):
+        import tempfile
+        made = list()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            item_cache = otCMSItemCache(cache_dir)
+            for i in range(3):
+                self.assertEqual(item_cache.item("key", lambda: made.append(1) or "item"), "item")
+            self.assertEqual((len(made), item_cache.hits, item_cache.misses), (1, 2, 1))
+            # and in the next build
+            self.assertEqual(otCMSItemCache(cache_dir).item("key", lambda: made.append(1) or "item"), "item")
+            self.assertEqual(len(made), 1)
+
+    def test_rdf_name(self):
+        self.assertEqual(rdfName("01-louvre.jpg"), "01-louvre.rdf")
+        self.assertEqual(rdfName("photo.v2.jpg"), "photo.v2.rdf")
+
+    def test_truncated_jpeg(self):
+        import tempfile
+        with tempfile.NamedTemporaryFile(suffix=".jpg") as jpeg_fh:
+            jpeg_fh.write(b"\xff\xd8\xff\xe0\x00")
+            jpeg_fh.flush()
+            self.assertEqual(probeJPEG(jpeg_fh.name), None)
+
+    def test_seeded_sample(self):
+        population = list(range(20))
+        self.assertEqual(seededSample(population, 5, "seed", "/2012/12-Bar/"), seededSample(population, 5, "seed", "/2012/12-Bar/"))
+        self.assertEqual(len(set(seededSample(population, 5, "seed", 0))), 5)
+        self.assertNotEqual([seededSample(population, 5, "seed", period) for period in range(3)],
+                            [seededSample(population, 5, "seed", 0)]*3)
+
+    def test_startup(self):
+        """refresh.py starts without importing its heavy dependencies, within a time budget"""
+        import subprocess
+        refresh_py = join(dirname(realpath(__file__)), "..", "bin", "refresh.py")
+        if not exists(refresh_py):
+            self.skipTest("refresh.py not found next to otCMS.py")
+        importtime = subprocess.run([sys.executable, "-X", "importtime", refresh_py, "--help"],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+        imported = dict()
+        for line in importtime.splitlines():
+            match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+            if match:
+                imported[match.group(3)] = (int(match.group(1)), len(match.group(2)))
+        for module in STARTUP_LAZY_IMPORTS:
+            self.assertNotIn(module, imported)
+        startup_us = sum(cumulative for cumulative, depth in imported.values() if depth == 0)
+        self.assertLess(startup_us, STARTUP_BUDGET_US)
+
+
+if __name__ == '__main__':
+    unittest.main()